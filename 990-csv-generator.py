@@ -1,9 +1,59 @@
 import xml.etree.ElementTree as ET
 import pandas as pd
 import argparse
+import contextlib
+import cProfile
+import functools
+import glob
+import hashlib
+import json
 import os
+import pstats
+import re
 import requests
-import subprocess
+import requests.adapters
+import shutil
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+import zipfile
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+# Parquet output is optional and needs pyarrow
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+    pq = None
+
+# lxml is optional; it parses several times faster than ElementTree and, with huge_tree,
+# accepts filings past libxml2's default size and depth limits
+try:
+    from lxml import etree as lxml_etree
+except ImportError:
+    lxml_etree = None
+
+# XML parser backends. Both build element trees with the same interface (tag, text, attrib,
+# iteration over children), so the extraction code runs unchanged on either.
+xml_backends = {
+    'etree': {
+        'parse': ET.parse,
+        'iterparse': ET.iterparse,
+    },
+}
+if lxml_etree is not None:
+    xml_backends['lxml'] = {
+        'parse': functools.partial(lxml_etree.parse, parser=lxml_etree.XMLParser(huge_tree=True)),
+        'iterparse': functools.partial(lxml_etree.iterparse, huge_tree=True),
+    }
+
+default_xml_backend = 'lxml' if 'lxml' in xml_backends else 'etree'
+
+# Errors raised for malformed XML by whichever backends are available
+xml_parse_errors = (ET.ParseError,) + ((lxml_etree.XMLSyntaxError,) if lxml_etree is not None else ())
 
 # Namespace dictionary for XPath expressions
 ns = {'irs': 'http://www.irs.gov/efile'}
@@ -13,32 +63,188 @@ def read_variables_from_csv(file_path):
     df = pd.read_csv(file_path)
     return df['Variables'].tolist()
 
+# Function to read the variables of a repeating table from a CSV file. Each variable is
+# relative to a row of the table, and its Variable_Prefix is the path to those rows.
+def read_table_variables_from_csv(file_path):
+    df = pd.read_csv(file_path)
+    return list(zip(df['Variable_Prefix'], df['Variables']))
+
 # Load variables from CSV files without 'irs:' prefix
 all_variables_file_path = './variables/all_variables.csv'
 recipient_variables_file_path = './variables/recipient_variables.csv'
 schedule_c_variables_file_path = './variables/schedule_c_variables.csv'
+compensation_variables_file_path = './variables/compensation_variables.csv'
+schedule_r_related_org_variables_file_path = './variables/schedule_r_related_org_variables.csv'
 
 all_variables = read_variables_from_csv(all_variables_file_path)
-recipient_variables = read_variables_from_csv(recipient_variables_file_path)
 schedule_c_variables = read_variables_from_csv(schedule_c_variables_file_path)
+recipient_table_variables = read_table_variables_from_csv(recipient_variables_file_path)
+compensation_table_variables = read_table_variables_from_csv(compensation_variables_file_path)
+schedule_r_related_org_table_variables = read_table_variables_from_csv(schedule_r_related_org_variables_file_path)
+
+# Function to read the pre-2013 names of renamed variables, as {legacy variable: variable}. A
+# legacy variable whose element was dropped in 2013 has an empty variable ('').
+def read_variable_aliases_from_csv(file_path):
+    df = pd.read_csv(file_path, dtype=str, keep_default_na=False)
+    return dict(zip(df['Legacy_Variables'], df['Variables']))
+
+variable_aliases_file_path = './variables/variable_aliases.csv'
+variable_aliases = read_variable_aliases_from_csv(variable_aliases_file_path)
+renamed_variables = {var for var in variable_aliases.values() if var}
+
+# The IRS renamed most e-file elements (adding the Amt, Ind, Txt, ... suffixes) in its 2013 schemas
+modern_schema_year = 2013
+
+
+# Function to tell which element names a filing uses from the returnVersion of its root element
+# (e.g. 2019v5.1): 'legacy' before the 2013 rename, 'modern' from then on, None if unknown
+def schema_era(return_version):
+    if return_version and return_version[:4].isdigit():
+        return 'legacy' if int(return_version[:4]) < modern_schema_year else 'modern'
+    return None
+
+
+# Function to drop the variables a schema era cannot contain: the pre-2013 names from modern
+# filings and the names that replaced them from legacy filings
+def era_variables(variables, era):
+    if era == 'modern':
+        return [var for var in variables if var not in variable_aliases]
+    if era == 'legacy':
+        return [var for var in variables if var not in renamed_variables]
+    return variables
+
+
+# Namespaced tag prefix carried by every element in an IRS e-file document
+ns_tag_prefix = '{' + ns['irs'] + '}'
+
+# Function to compile a list of variables into a path trie keyed by namespaced tag. With an
+# era, only the variables that era can contain go into the trie; the output layout still has
+# every variable. With aliases merged, the layout drops each pre-2013 variable whose 2013 name
+# is also in the list, and its value goes to that variable's column instead.
+def compile_variables(variables, era=None):
+    trie = {'children': {}, 'vars': []}
+    for var in era_variables(variables, era):
+        xpath_expr = var.replace('/text()', '')
+
+        node = trie
+        for part in xpath_expr.split('/'):
+            if part:
+                node = node['children'].setdefault(ns_tag_prefix + part, {'children': {}, 'vars': []})
+        node['vars'].append(var)
+
+    variable_set = set(variables)
+    aliases = {}
+    for var in variables:
+        if variable_aliases.get(var) in variable_set:
+            aliases.setdefault(variable_aliases[var], []).append(var)
+    merged_variables = [var for var in variables if variable_aliases.get(var) not in variable_set]
+
+    return {'variables': variables, 'trie': trie, 'merged_variables': merged_variables, 'aliases': aliases}
+
 
+# Function to find the element matched for a variable or, with aliases merged, for its aliases
+def matched_element(compiled_variables, var, matches, merge_aliases=False):
+    element = matches.get(var)
+    if element is None and merge_aliases:
+        for alias in compiled_variables['aliases'].get(var, []):
+            element = matches.get(alias)
+            if element is not None:
+                break
+    return element
 
-def extract_variables_and_attr_from_xml(xml_file, variables):
-    tree = ET.parse(xml_file)
+
+# Function to walk the document once, recording the first element that matches each variable
+def match_compiled_variables(element, node, matches):
+    for child in element:
+        child_node = node['children'].get(child.tag)
+        if child_node is None:
+            continue
+        for var in child_node['vars']:
+            # Keep the first match in document order, same as root.find()
+            if var not in matches:
+                matches[var] = child
+        if child_node['children']:
+            match_compiled_variables(child, child_node, matches)
+
+
+# Function to compile a repeating table. Its row prefixes locate the row elements, and its
+# variables are compiled into a path trie relative to a row, so each row takes a single walk.
+# The fields are compiled for each schema era.
+def compile_table(name, table_variables):
+    prefixes = list(dict.fromkeys(prefix for prefix, _ in table_variables))
+    variables = list(dict.fromkeys(var for _, var in table_variables))
+    fields = {era: compile_variables(variables, era) for era in (None, 'legacy', 'modern')}
+    return {'name': name, 'prefixes': prefixes, 'variables': variables, 'fields': fields}
+
+
+# Function to merge the row prefixes of several tables into one path trie, whose nodes list
+# the names of the tables that have rows at that path. Prefixes are filtered by era like variables.
+def compile_table_rows(tables, era=None):
+    trie = {'children': {}, 'vars': []}
+    for table in tables:
+        for prefix in era_variables(table['prefixes'], era):
+            node = trie
+            for part in prefix.split('/'):
+                if part:
+                    node = node['children'].setdefault(ns_tag_prefix + part, {'children': {}, 'vars': []})
+            node['vars'].append(table['name'])
+
+    return {'tables': {table['name']: table for table in tables}, 'trie': trie, 'era': era}
+
+
+# Function to hand each row element of the compiled tables to on_row(table name, element),
+# in document order. Only the subtrees on a row prefix are descended into.
+def match_table_rows(element, node, on_row):
+    for child in element:
+        child_node = node['children'].get(child.tag)
+        if child_node is None:
+            continue
+        for table_name in child_node['vars']:
+            on_row(table_name, child)
+        if child_node['children']:
+            match_table_rows(child, child_node, on_row)
+
+
+# Function to extract one row of a table from its row element
+def extract_table_row(element, object_id, table, era=None, merge_aliases=False):
+    fields = table['fields'][era]
+    matches = {}
+    match_compiled_variables(element, fields['trie'], matches)
+
+    table_row = {'OBJECT_ID': object_id}
+    for var in fields['merged_variables'] if merge_aliases else fields['variables']:
+        # Missing fields are left empty, as findtext() did
+        field = matched_element(fields, var, matches, merge_aliases)
+        table_row[var] = (field.text or '') if field is not None else ''
+
+    return table_row
+
+
+# Compile the variable lists once at startup so each filing costs a single tree walk
+all_variables_compiled = compile_variables(all_variables)
+schedule_c_variables_compiled = compile_variables(schedule_c_variables)
+schedule_c_variable_set = set(schedule_c_variables)
+
+recipient_table = compile_table('recipient', recipient_table_variables)
+compensation_table = compile_table('compensation', compensation_table_variables)
+schedule_r_related_org_table = compile_table('schedule_r_related_org', schedule_r_related_org_table_variables)
+
+
+def extract_variables_and_attr_from_xml(xml_file, compiled_variables, backend='etree'):
+    tree = xml_backends[backend]['parse'](xml_file)
     root = tree.getroot()
-    
+
+    matches = {}
+    match_compiled_variables(root, compiled_variables['trie'], matches)
+
+    return build_extracted_data(compiled_variables, matches)
+
+
+# Function to lay out matched elements as one output row, in variable order
+def build_extracted_data(compiled_variables, matches, merge_aliases=False):
     extracted_data = {}
-    for var in variables:
-        xpath_expr = var.replace('/text()', '')  
-        
-        # Split the XPath expression and prepend 'irs:' to each part
-        xpath_parts = xpath_expr.split('/')
-        # Apply the 'irs:' prefix only to the actual XML elements
-        xpath_expr = '/'.join('irs:' + part for part in xpath_parts if part)
-
-        #print(xpath_expr)  # Debugging statement to verify the XPath expression
-        
-        element = root.find(xpath_expr, ns)
+    for var in compiled_variables['merged_variables'] if merge_aliases else compiled_variables['variables']:
+        element = matched_element(compiled_variables, var, matches, merge_aliases)
         extracted_data[var] = element.text if element is not None else None
         if element is not None:
             for key, value in element.attrib.items():
@@ -48,419 +254,1829 @@ def extract_variables_and_attr_from_xml(xml_file, variables):
 
 
 
-def download_index_csv(year):
-    url = f'https://apps.irs.gov/pub/epostcard/990/xml/{year}/index_{year}.csv'
-    local_path = f'data/index_file/index_{year}.csv'
-    
+# Base URL of the IRS e-file XML data; point IRS_BASE_URL at a local stand-in server for testing
+irs_base_url = os.environ.get('IRS_BASE_URL', 'https://apps.irs.gov/pub/epostcard/990/xml')
+
+# ZIP batches published for the legacy years, which have no XML_BATCH_ID in their index CSV
+legacy_zip_batches = {
+    2023: [
+        "2023_TEOS_XML_01A",
+        "2023_TEOS_XML_02A",
+        "2023_TEOS_XML_03A",
+        "2023_TEOS_XML_04A",
+        "2023_TEOS_XML_05A",
+        "2023_TEOS_XML_05B",
+        "2023_TEOS_XML_06A",
+        "2023_TEOS_XML_07A",
+        "2023_TEOS_XML_08A",
+        "2023_TEOS_XML_09A",
+        "2023_TEOS_XML_10A",
+        "2023_TEOS_XML_11A",
+        "2023_TEOS_XML_11B",
+        "2023_TEOS_XML_11C",
+        "2023_TEOS_XML_12A",
+    ],
+    2022: [
+        "2022_TEOS_XML_01A",
+        "2022_TEOS_XML_01B",
+        "2022_TEOS_XML_01C",
+        "2022_TEOS_XML_01D",
+        "2022_TEOS_XML_01E",
+        "2022_TEOS_XML_01F",
+        "2022_TEOS_XML_11A",
+        "2022_TEOS_XML_11B",
+        "2022_TEOS_XML_11C",
+    ],
+    2021: [
+        "2021_TEOS_XML_01A",
+        "2021_TEOS_XML_01B",
+        "2021_TEOS_XML_01C",
+        "2021_TEOS_XML_01D",
+        "2021_TEOS_XML_01E",
+        "2021_TEOS_XML_01F",
+        "2021_TEOS_XML_01G",
+        "2021_TEOS_XML_01H",
+    ],
+    2020: [
+        "2020_TEOS_XML_CT1",
+        "download990xml_2020_1",
+        "download990xml_2020_2",
+        "download990xml_2020_3",
+        "download990xml_2020_4",
+        "download990xml_2020_5",
+        "download990xml_2020_6",
+        "download990xml_2020_7",
+        "download990xml_2020_8",
+    ],
+    2019: [
+        "2019_TEOS_XML_CT1",
+        "download990xml_2019_1",
+        "download990xml_2019_2",
+        "download990xml_2019_3",
+        "download990xml_2019_4",
+        "download990xml_2019_5",
+        "download990xml_2019_6",
+        "download990xml_2019_7",
+        "download990xml_2019_8",
+    ],
+    2018: [
+        "2018_TEOS_XML_CT1",
+        "2018_TEOS_XML_CT2",
+        "2018_TEOS_XML_CT3",
+        "download990xml_2018_1",
+        "download990xml_2018_2",
+        "download990xml_2018_3",
+        "download990xml_2018_4",
+        "download990xml_2018_5",
+        "download990xml_2018_6",
+        "download990xml_2018_7",
+    ],
+}
+
+
+# Wall-clock seconds and counters of an extraction run, by stage. Worker processes collect
+# their own for each batch and the main process merges them in, so the seconds of the stages
+# that run in workers (scan, parse, lookup, ...) are summed over the workers.
+class RunStats:
+    def __init__(self):
+        self.seconds = {}
+        self.counts = {}
+        # Downloads count their bytes from several threads at once
+        self.lock = threading.Lock()
+
+    def __getstate__(self):
+        # Only the figures are sent between processes; the lock stays behind
+        return {'seconds': self.seconds, 'counts': self.counts}
+
+    def __setstate__(self, state):
+        self.__init__()
+        self.seconds.update(state['seconds'])
+        self.counts.update(state['counts'])
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_seconds(name, time.perf_counter() - start)
+
+    def add_seconds(self, name, seconds):
+        with self.lock:
+            self.seconds[name] = self.seconds.get(name, 0.0) + seconds
+
+    def count(self, name, n=1):
+        with self.lock:
+            self.counts[name] = self.counts.get(name, 0) + n
+
+    def merge(self, other):
+        for name, seconds in other.seconds.items():
+            self.add_seconds(name, seconds)
+        for name, n in other.counts.items():
+            self.count(name, n)
+
+    def reset(self):
+        with self.lock:
+            self.seconds.clear()
+            self.counts.clear()
+
+
+# Stats of the current run in the main process
+run_stats = RunStats()
+
+
+# Function to create an HTTP session whose connection pool is shared by concurrent downloads
+def create_download_session(download_workers=4):
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=download_workers, pool_maxsize=download_workers)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+# Function to stream a URL to disk in chunks. The download is written to a .part file that is
+# resumed with an HTTP Range request after an interruption, checked against the size the server
+# reported, and only then renamed into place, so a file that already exists is complete.
+# Connection errors and server errors (5xx) are retried; client errors (4xx) fail at once.
+# Bytes and files downloaded are counted into stats (by default the current run's).
+def download_file(session, url, local_path, chunk_size=1024 * 1024, retries=3, stats=None):
+    stats = stats or run_stats
+    if os.path.exists(local_path):
+        print(f"Using existing {local_path}.")
+        return local_path
+
     if not os.path.exists(os.path.dirname(local_path)):
-        os.makedirs(os.path.dirname(local_path))
+        os.makedirs(os.path.dirname(local_path), exist_ok=True)
+
+    part_path = local_path + '.part'
+    for attempt in range(retries + 1):
+        offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+        # Ask for the bytes as stored, so sizes and ranges count the same bytes that are written
+        headers = {'Accept-Encoding': 'identity'}
+        if offset:
+            headers['Range'] = f'bytes={offset}-'
+        try:
+            with session.get(url, headers=headers, stream=True, timeout=60) as response:
+                if response.status_code == 416:
+                    # Nothing left to fetch: the partial file is either complete or stale
+                    total_size = int(response.headers.get('Content-Range', 'bytes */-1').split('/')[-1])
+                    if total_size == offset:
+                        os.replace(part_path, local_path)
+                        return local_path
+                    os.remove(part_path)
+                    continue
+                response.raise_for_status()  # Check that the request was successful
+
+                if response.status_code == 206:
+                    total_size = int(response.headers['Content-Range'].split('/')[-1])
+                else:
+                    # The server ignored the Range header, so start over
+                    offset = 0
+                    total_size = int(response.headers['Content-Length']) if 'Content-Length' in response.headers else None
+
+                with open(part_path, 'ab' if offset else 'wb') as file:
+                    for chunk in response.iter_content(chunk_size=chunk_size):
+                        file.write(chunk)
+                        stats.count('bytes_downloaded', len(chunk))
+
+            downloaded_size = os.path.getsize(part_path)
+            if total_size is not None and downloaded_size != total_size:
+                if downloaded_size > total_size:
+                    os.remove(part_path)
+                raise IOError(f"Downloaded {downloaded_size} of {total_size} bytes from {url}.")
+
+            os.replace(part_path, local_path)
+            stats.count('files_downloaded')
+            return local_path
+        except (requests.RequestException, IOError) as e:
+            # Client errors (a missing file, a refused request) will not go away on a retry
+            if isinstance(e, requests.HTTPError) and e.response is not None and e.response.status_code < 500:
+                raise
+            if attempt == retries:
+                raise
+            print(f"Retrying {url} after error: {e}")
+            time.sleep(2 ** attempt)
+
+    raise IOError(f"Could not download {url}.")
+
+
+# Function to download several files at once over one pooled session
+def download_files(downloads, download_workers=4, session=None, stats=None):
+    session = session or create_download_session(download_workers)
+
+    with ThreadPoolExecutor(max_workers=download_workers) as executor:
+        futures = [executor.submit(download_file, session, url, local_path, stats=stats)
+                   for url, local_path in downloads]
+
+    errors = [future.exception() for future in futures if future.exception() is not None]
+    for error in errors:
+        print(f"Error downloading: {error}")
+    if errors:
+        raise errors[0]
+
+    return [future.result() for future in futures]
+
+
+def download_index_csv(year, session=None, refresh=False, stats=None):
+    url = f'{irs_base_url}/{year}/index_{year}.csv'
+    local_path = f'data/index_file/index_{year}.csv'
+
+    if refresh and os.path.exists(local_path):
+        # Fetch the re-published index beside the old one and swap it in once complete
+        refreshed_path = local_path + '.new'
+        if os.path.exists(refreshed_path):
+            os.remove(refreshed_path)
+        download_file(session or create_download_session(), url, refreshed_path, stats=stats)
+        os.replace(refreshed_path, local_path)
     else:
-        print(f"Using existing index CSV for year {year}.")
-    
-    response = requests.get(url)
-    response.raise_for_status()  # Check that the request was successful
-    
-    with open(local_path, 'wb') as file:
-        file.write(response.content)
+        download_file(session or create_download_session(), url, local_path, stats=stats)
     
     print(f"Downloaded index CSV for year {year}.")
     return local_path
 
-def download_and_extract_zip(xml_files_path_prefix, xml_batch_id, year):
-    zip_url = f'https://apps.irs.gov/pub/epostcard/990/xml/{year}/{xml_batch_id}.zip'
-    local_zip_path = f'{xml_files_path_prefix}{xml_batch_id}.zip'
-    
-    if not os.path.exists(xml_files_path_prefix):
-        os.makedirs(xml_files_path_prefix)
-    
-    response = requests.get(zip_url)
-    response.raise_for_status()  # Check that the request was successful
-    
-    with open(local_zip_path, 'wb') as file:
-        file.write(response.content)
 
-    xml_files_path = f'{xml_files_path_prefix}{xml_batch_id}/'
-    
-    try:
-        subprocess.run(['unzip', local_zip_path, '-d', xml_files_path], check=True)
-    except subprocess.CalledProcessError as e:
-        print(f"Error extracting {local_zip_path}: {e}")
-    
-    print(f"Downloaded and extracted {xml_batch_id}.zip.")
-
-def download_and_extract_zip_legacy(xml_files_path, year):
-    zip_batches = {
-        2023: [
-            "https://apps.irs.gov/pub/epostcard/990/xml/2023/2023_TEOS_XML_01A.zip",
-            "https://apps.irs.gov/pub/epostcard/990/xml/2023/2023_TEOS_XML_02A.zip",
-            "https://apps.irs.gov/pub/epostcard/990/xml/2023/2023_TEOS_XML_03A.zip",
-            "https://apps.irs.gov/pub/epostcard/990/xml/2023/2023_TEOS_XML_04A.zip",
-            "https://apps.irs.gov/pub/epostcard/990/xml/2023/2023_TEOS_XML_05A.zip",
-            "https://apps.irs.gov/pub/epostcard/990/xml/2023/2023_TEOS_XML_05B.zip",
-            "https://apps.irs.gov/pub/epostcard/990/xml/2023/2023_TEOS_XML_06A.zip",
-            "https://apps.irs.gov/pub/epostcard/990/xml/2023/2023_TEOS_XML_07A.zip",
-            "https://apps.irs.gov/pub/epostcard/990/xml/2023/2023_TEOS_XML_08A.zip",
-            "https://apps.irs.gov/pub/epostcard/990/xml/2023/2023_TEOS_XML_09A.zip",
-            "https://apps.irs.gov/pub/epostcard/990/xml/2023/2023_TEOS_XML_10A.zip",
-            "https://apps.irs.gov/pub/epostcard/990/xml/2023/2023_TEOS_XML_11A.zip",
-            "https://apps.irs.gov/pub/epostcard/990/xml/2023/2023_TEOS_XML_11B.zip",
-            "https://apps.irs.gov/pub/epostcard/990/xml/2023/2023_TEOS_XML_11C.zip",
-            "https://apps.irs.gov/pub/epostcard/990/xml/2023/2023_TEOS_XML_12A.zip",
-        ],
-        2022: [
-            "https://apps.irs.gov/pub/epostcard/990/xml/2022/2022_TEOS_XML_01A.zip",
-            "https://apps.irs.gov/pub/epostcard/990/xml/2022/2022_TEOS_XML_01B.zip",
-            "https://apps.irs.gov/pub/epostcard/990/xml/2022/2022_TEOS_XML_01C.zip",
-            "https://apps.irs.gov/pub/epostcard/990/xml/2022/2022_TEOS_XML_01D.zip",
-            "https://apps.irs.gov/pub/epostcard/990/xml/2022/2022_TEOS_XML_01E.zip",
-            "https://apps.irs.gov/pub/epostcard/990/xml/2022/2022_TEOS_XML_01F.zip",
-            "https://apps.irs.gov/pub/epostcard/990/xml/2022/2022_TEOS_XML_11A.zip",
-            "https://apps.irs.gov/pub/epostcard/990/xml/2022/2022_TEOS_XML_11B.zip",
-            "https://apps.irs.gov/pub/epostcard/990/xml/2022/2022_TEOS_XML_11C.zip",
-        ],
-        2021: [
-            "https://apps.irs.gov/pub/epostcard/990/xml/2021/2021_TEOS_XML_01A.zip",
-            "https://apps.irs.gov/pub/epostcard/990/xml/2021/2021_TEOS_XML_01B.zip",
-            "https://apps.irs.gov/pub/epostcard/990/xml/2021/2021_TEOS_XML_01C.zip",
-            "https://apps.irs.gov/pub/epostcard/990/xml/2021/2021_TEOS_XML_01D.zip",
-            "https://apps.irs.gov/pub/epostcard/990/xml/2021/2021_TEOS_XML_01E.zip",
-            "https://apps.irs.gov/pub/epostcard/990/xml/2021/2021_TEOS_XML_01F.zip",
-            "https://apps.irs.gov/pub/epostcard/990/xml/2021/2021_TEOS_XML_01G.zip",
-            "https://apps.irs.gov/pub/epostcard/990/xml/2021/2021_TEOS_XML_01H.zip",
-        ],
-        2020: [
-            "https://apps.irs.gov/pub/epostcard/990/xml/2020/2020_TEOS_XML_CT1.zip",
-            "https://apps.irs.gov/pub/epostcard/990/xml/2020/download990xml_2020_1.zip",
-            "https://apps.irs.gov/pub/epostcard/990/xml/2020/download990xml_2020_2.zip",
-            "https://apps.irs.gov/pub/epostcard/990/xml/2020/download990xml_2020_3.zip",
-            "https://apps.irs.gov/pub/epostcard/990/xml/2020/download990xml_2020_4.zip",
-            "https://apps.irs.gov/pub/epostcard/990/xml/2020/download990xml_2020_5.zip",
-            "https://apps.irs.gov/pub/epostcard/990/xml/2020/download990xml_2020_6.zip",
-            "https://apps.irs.gov/pub/epostcard/990/xml/2020/download990xml_2020_7.zip",
-            "https://apps.irs.gov/pub/epostcard/990/xml/2020/download990xml_2020_8.zip",
-        ],
-        2019: [
-            "https://apps.irs.gov/pub/epostcard/990/xml/2019/2019_TEOS_XML_CT1.zip",
-            "https://apps.irs.gov/pub/epostcard/990/xml/2019/download990xml_2019_1.zip",
-            "https://apps.irs.gov/pub/epostcard/990/xml/2019/download990xml_2019_2.zip",
-            "https://apps.irs.gov/pub/epostcard/990/xml/2019/download990xml_2019_3.zip",
-            "https://apps.irs.gov/pub/epostcard/990/xml/2019/download990xml_2019_4.zip",
-            "https://apps.irs.gov/pub/epostcard/990/xml/2019/download990xml_2019_5.zip",
-            "https://apps.irs.gov/pub/epostcard/990/xml/2019/download990xml_2019_6.zip",
-            "https://apps.irs.gov/pub/epostcard/990/xml/2019/download990xml_2019_7.zip",
-            "https://apps.irs.gov/pub/epostcard/990/xml/2019/download990xml_2019_8.zip",
-        ],
-        2018: [
-            "https://apps.irs.gov/pub/epostcard/990/xml/2018/2018_TEOS_XML_CT1.zip",
-            "https://apps.irs.gov/pub/epostcard/990/xml/2018/2018_TEOS_XML_CT2.zip",
-            "https://apps.irs.gov/pub/epostcard/990/xml/2018/2018_TEOS_XML_CT3.zip",
-            "https://apps.irs.gov/pub/epostcard/990/xml/2018/download990xml_2018_1.zip",
-            "https://apps.irs.gov/pub/epostcard/990/xml/2018/download990xml_2018_2.zip",
-            "https://apps.irs.gov/pub/epostcard/990/xml/2018/download990xml_2018_3.zip",
-            "https://apps.irs.gov/pub/epostcard/990/xml/2018/download990xml_2018_4.zip",
-            "https://apps.irs.gov/pub/epostcard/990/xml/2018/download990xml_2018_5.zip",
-            "https://apps.irs.gov/pub/epostcard/990/xml/2018/download990xml_2018_6.zip",
-            "https://apps.irs.gov/pub/epostcard/990/xml/2018/download990xml_2018_7.zip",
-        ],
-    }
+def download_zips(xml_files_path_prefix, xml_batch_ids, year, download_workers=4, session=None, stats=None):
+    downloads = [(f'{irs_base_url}/{year}/{xml_batch_id}.zip', f'{xml_files_path_prefix}{xml_batch_id}.zip')
+                 for xml_batch_id in xml_batch_ids]
 
-    if year in zip_batches:
-        zip_urls = zip_batches[year]
-    else:
+    download_files(downloads, download_workers, session, stats)
+
+    for xml_batch_id in xml_batch_ids:
+        print(f"Downloaded {xml_batch_id}.zip.")
+
+
+def download_zip_legacy(xml_files_path, year, download_workers=4, session=None, stats=None):
+    if year not in legacy_zip_batches:
         print(f"No ZIP batch URLs defined for the year {year}.")
         return
-    
-    for zip_url in zip_urls:
-        local_zip_path = os.path.join(xml_files_path, os.path.basename(zip_url))
-        
-        if not os.path.exists(xml_files_path):
-            os.makedirs(xml_files_path)
-        
-        response = requests.get(zip_url)
-        response.raise_for_status()  # Check that the request was successful
-        
-        with open(local_zip_path, 'wb') as file:
-            file.write(response.content)
-        
-        try:
-            subprocess.run(['unzip', local_zip_path, '-d', xml_files_path], check=True)
-        except subprocess.CalledProcessError as e:
-            print(f"Error extracting {local_zip_path}: {e}")
-        
-        print(f"Downloaded and extracted {os.path.basename(zip_url)}.")
 
-def extract_index_data(year, form_type):
-    index_csv_path = f'data/index_file/index_{year}.csv'
-    
-    # Download the index CSV if it does not exist
-    if not os.path.exists(index_csv_path):
-        index_csv_path = download_index_csv(year)
-    
-    index_df = pd.read_csv(index_csv_path, nrows= 150)
+    download_zips(xml_files_path, legacy_zip_batches[year], year, download_workers, session, stats)
+
+
+# Function to index every filing in a year's ZIP archives as OBJECT_ID -> (zip, member), so
+# filings are read straight out of the archives instead of being unzipped to disk. Legacy
+# batches repeat some file names across archives; the first copy in archive name order is
+# indexed, and the later copies are logged to duplicate_files.txt in the year's folder.
+def build_filing_index(xml_files_path_prefix):
+    filing_index = {}
+    duplicates = []
+
+    for zip_path in sorted(glob.glob(os.path.join(xml_files_path_prefix, '*.zip'))):
+        with zipfile.ZipFile(zip_path) as archive:
+            for member in archive.namelist():
+                file_name = os.path.basename(member)
+                if not file_name.endswith('_public.xml'):
+                    continue
+                object_id = file_name[:-len('_public.xml')]
+                if object_id in filing_index:
+                    duplicates.append(f"{zip_path}/{member}")
+                else:
+                    filing_index[object_id] = (zip_path, member)
+
+    if duplicates:
+        with open(os.path.join(xml_files_path_prefix, 'duplicate_files.txt'), 'w') as file:
+            file.write('\n'.join(duplicates) + '\n')
+        print(f"Skipped {len(duplicates)} duplicate filings across ZIP archives.")
+
+    return filing_index
+
+
+# ZIP archives opened by this process, kept open so the central directory is read only once
+open_archives = {'pid': None, 'archives': {}}
+
+
+# Function to open a filing for parsing, either a loose XML file or a member of a ZIP archive
+def open_filing(filing_source):
+    if isinstance(filing_source, str):
+        return open(filing_source, 'rb')
+
+    # Worker processes must not share ZipFile handles (and their file offsets) with their parent
+    if open_archives['pid'] != os.getpid():
+        open_archives['pid'] = os.getpid()
+        open_archives['archives'] = {}
+
+    zip_path, member = filing_source
+    archive = open_archives['archives'].get(zip_path)
+    if archive is None:
+        archive = open_archives['archives'][zip_path] = zipfile.ZipFile(zip_path)
+    return archive.open(member)
+
+
+# Function to name a filing in messages
+def filing_label(filing_source):
+    if isinstance(filing_source, str):
+        return filing_source
+    return '/'.join(filing_source)
+
+
+# Function to get the uncompressed size of a filing opened with open_filing
+def filing_size(filing_source):
+    if isinstance(filing_source, str):
+        return os.path.getsize(filing_source)
+    zip_path, member = filing_source
+    return open_archives['archives'][zip_path].getinfo(member).file_size
+
+
+# Start tag of a schedule, e.g. <IRS990ScheduleC> or <IRS990ScheduleC documentId="...">
+schedule_tag_pattern = re.compile(rb'<(?:[\w.-]+:)?(IRS990Schedule[A-Z])[\s/>]')
+
+# Element name of a schedule, e.g. IRS990ScheduleC
+schedule_name_pattern = re.compile(r'IRS990Schedule[A-Z]')
+
+
+# Function to add an element to schedules if it is a schedule, e.g. <IRS990ScheduleC>. Comments
+# and processing instructions (whose tag is not a string under lxml) are skipped.
+def collect_schedule(element, schedules):
+    if not isinstance(element.tag, str):
+        return
+    name = element.tag.rsplit('}', 1)[-1]
+    if schedule_name_pattern.fullmatch(name):
+        schedules.add(name)
+
+
+# Function to list the schedules a filing contains by scanning its bytes for schedule start
+# tags, which costs a fraction of a parse. The file is read in chunks, each overlapping the
+# previous one so tags split across chunks are still found.
+def scan_filing_schedules(xml_file, chunk_size=1024 * 1024):
+    schedules = set()
+    tail = b''
+    while True:
+        chunk = xml_file.read(chunk_size)
+        if not chunk:
+            break
+        data = tail + chunk
+        schedules.update(schedule.decode('ascii') for schedule in schedule_tag_pattern.findall(data))
+        tail = data[-64:]
+    return sorted(schedules)
+
+
+# Function to tell whether a product needs a filing, given the schedules the filing contains
+# (None if not known yet). Products tied to a schedule do not need filings without it.
+def product_needs_filing(product, schedules):
+    schedule = extraction_products[product]['schedule']
+    return schedule is None or schedules is None or schedule in schedules
+
+
+# Function to read the per-year sidecar index of the schedules each filing contains
+def read_schedule_index(year):
+    schedule_index_path = f'data/schedule_index/schedules_{year}.csv'
+    if not os.path.exists(schedule_index_path):
+        return {}
+    schedule_index_df = pd.read_csv(schedule_index_path, dtype=str, keep_default_na=False)
+    return {object_id: schedules.split() for object_id, schedules in
+            zip(schedule_index_df['OBJECT_ID'], schedule_index_df['SCHEDULES'])}
+
+
+# Function to add scanned filings ({OBJECT_ID: schedules}) to the year's schedule index
+def append_schedule_index(year, scanned_schedules):
+    schedule_index_path = f'data/schedule_index/schedules_{year}.csv'
+    if not os.path.exists(os.path.dirname(schedule_index_path)):
+        os.makedirs(os.path.dirname(schedule_index_path))
+
+    append = os.path.exists(schedule_index_path)
+    pd.DataFrame({'OBJECT_ID': list(scanned_schedules),
+                  'SCHEDULES': [' '.join(schedules) for schedules in scanned_schedules.values()]}).to_csv(
+        schedule_index_path, mode='a' if append else 'w', header=not append, index=False)
+
+
+# Columns of the IRS index CSV. All are read as strings: they are identifiers (EINs keep
+# their leading zeros) and are only copied into the output rows.
+index_columns = ['RETURN_ID', 'FILING_TYPE', 'EIN', 'TAX_PERIOD', 'SUB_DATE', 'TAXPAYER_NAME', 'RETURN_TYPE',
+                 'DLN', 'OBJECT_ID', 'XML_BATCH_ID']
+
+# Index columns every run needs to find and filter filings, whatever the products
+filing_columns = ['RETURN_TYPE', 'OBJECT_ID', 'XML_BATCH_ID']
+
+
+# Function to load the index rows of one form type. Only the given columns are read, and the
+# file is filtered in chunks as it is read, so the rows of other forms (and the OBJECT_IDs in
+# exclude) are never held in memory. limit keeps the first rows and sample a random but
+# repeatable set of the remaining rows.
+def load_index(index_csv_path, form_type, columns, exclude=None, limit=None, sample=None, chunksize=100000):
+    chunks = pd.read_csv(index_csv_path, usecols=lambda column: column in columns, dtype=str,
+                         keep_default_na=False, chunksize=chunksize)
+
+    form_chunks = []
+    form_rows = 0
+    for chunk in chunks:
+        chunk = chunk[chunk['RETURN_TYPE'] == form_type]
+        if exclude:
+            chunk = chunk[~chunk['OBJECT_ID'].isin(exclude)]
+        form_chunks.append(chunk)
+        form_rows += len(chunk)
+        if limit is not None and sample is None and form_rows >= limit:
+            break
 
-    # Filter the index DataFrame to include only rows with the specified form type
-    index_df = index_df[index_df['RETURN_TYPE'] == form_type]
+    index_df = pd.concat(form_chunks, ignore_index=True) if form_chunks else pd.DataFrame(columns=columns)
+    if sample is not None and sample < len(index_df):
+        index_df = index_df.sample(n=sample, random_state=0).sort_index()
+    if limit is not None:
+        index_df = index_df.head(limit)
 
+    return index_df.reset_index(drop=True)
+
+
+# Function to download the ZIP batches holding the filings of the index rows that are not on disk yet
+def download_year_filings(index_df, year, download_workers=4, session=None, stats=None):
+    xml_files_path_prefix = f'data/xml_files/{year}/'
+
+    if year < 2024:
+        # Download the ZIP files if the XML folder does not exist, or resume an interrupted download
+        if not index_df.empty and (not os.path.exists(xml_files_path_prefix) or
+                                   glob.glob(os.path.join(xml_files_path_prefix, '*.zip.part'))):
+            download_zip_legacy(xml_files_path_prefix, year, download_workers, session, stats)
+    else:
+        # Download the ZIP files for which neither the archive nor an unzipped XML folder exists
+        missing_batch_ids = [xml_batch_id for xml_batch_id in index_df['XML_BATCH_ID'].unique()
+                             if not os.path.exists(f"{xml_files_path_prefix}{xml_batch_id}.zip") and
+                             not os.path.exists(f"{xml_files_path_prefix}{xml_batch_id}/")]
+        if missing_batch_ids:
+            download_zips(xml_files_path_prefix, missing_batch_ids, year, download_workers, session, stats)
+
+
+# Function to pair each index row with its filing, downloading any missing ZIP batches first.
+# Filings are looked up in the archive index; a filing that is not in any archive falls back
+# to the loose XML file an earlier, unzipped download would have left on disk.
+def list_filing_tasks(index_df, year, download_workers=4, session=None):
     xml_files_path_prefix = f'data/xml_files/{year}/'
 
-    # List to hold all extracted data
-    all_extracted_data = []
+    with run_stats.stage('download'):
+        download_year_filings(index_df, year, download_workers, session)
+
+    with run_stats.stage('archive_index'):
+        filing_index = build_filing_index(xml_files_path_prefix)
 
+    # Index rows are handed to workers as plain tuples in the column order of index_df
     if year < 2024:
-        for _, row in index_df.iterrows():
-            xml_folder_path = f"{xml_files_path_prefix}"
-            xml_file = f"{xml_folder_path}{row['OBJECT_ID']}_public.xml"
-            
-            # Download and extract the ZIP file if the XML folder does not exist
-            if not os.path.exists(xml_folder_path):
-                download_and_extract_zip_legacy(xml_files_path_prefix, year)
-            
-            try:
-                extracted_data = extract_variables_and_attr_from_xml(xml_file, all_variables)
-                # Combine index data and extracted data
-                combined_data = row.to_dict()  # Convert index row to dictionary
-                combined_data.update(extracted_data)  # Add extracted data
-                all_extracted_data.append(combined_data)  # Append to list
-            except ET.ParseError:
-                print(f"Error parsing {xml_file}.")
-            except FileNotFoundError:
-                print(f"File {xml_file} not found.")
+        xml_files = xml_files_path_prefix + index_df['OBJECT_ID'] + '_public.xml'
     else:
-        for _, row in index_df.iterrows():
-            xml_folder_path = f"{xml_files_path_prefix}{row['XML_BATCH_ID']}/"
-            xml_file = f"{xml_folder_path}{row['OBJECT_ID']}_public.xml"
-            
-            # Download and extract the ZIP file if the XML folder does not exist
-            if not os.path.exists(xml_folder_path):
-                download_and_extract_zip(xml_files_path_prefix, row['XML_BATCH_ID'], year)
-            
+        xml_files = xml_files_path_prefix + index_df['XML_BATCH_ID'] + '/' + index_df['OBJECT_ID'] + '_public.xml'
+    filing_sources = [filing_index.get(object_id, xml_file)
+                      for object_id, xml_file in zip(index_df['OBJECT_ID'], xml_files)]
+
+    return list(zip(index_df.itertuples(index=False, name=None), filing_sources))
+
+
+# Function to parse a filing once and collect everything the requested products need: the
+# first element matching each variable and the rows of each table. The variables and tables are
+# compiled for the schema era of the filing's returnVersion, so only the names it can use are probed.
+# The parse (which includes inflating a ZIP member) and the lookups are timed into stats, if given;
+# in streaming mode the two are interleaved and all of it counts as parse. The schedules in the
+# filing's ReturnData are added to the schedules set, if given.
+def extract_filing(xml_file, object_id, products, streaming=False, merge_aliases=False, backend='etree',
+                   stats=None, schedules=None):
+    stats = stats or RunStats()
+    table_rows = {extraction_products[product]['table']['name']: [] for product in products
+                  if extraction_products[product]['table'] is not None}
+    compiled = {}
+
+    def compile_for_root(root):
+        era = schema_era(root.get('returnVersion'))
+        compiled['tables'] = compile_product_tables(products, era)
+        return compile_product_variables(products, era), compiled['tables']
+
+    def on_row(table_name, element):
+        compiled_tables = compiled['tables']
+        table_rows[table_name].append(extract_table_row(element, object_id, compiled_tables['tables'][table_name],
+                                                        compiled_tables['era'], merge_aliases))
+
+    if streaming:
+        # Streaming mode never builds the full ElementTree
+        with stats.stage('parse'):
+            matches = iterparse_filing(xml_file, on_row=on_row, on_root=compile_for_root, backend=backend,
+                                       schedules=schedules)
+    else:
+        with stats.stage('parse'):
+            tree = xml_backends[backend]['parse'](xml_file)
+            root = tree.getroot()
+
+        with stats.stage('lookup'):
+            compiled_variables, compiled_tables = compile_for_root(root)
+            matches = {}
+            match_compiled_variables(root, compiled_variables['trie'], matches)
+            if compiled_tables:
+                match_table_rows(root, compiled_tables['trie'], on_row)
+            if schedules is not None:
+                for section in root:
+                    if not isinstance(section.tag, str):
+                        continue
+                    for element in section:
+                        collect_schedule(element, schedules)
+
+    return matches, table_rows
+
+
+# Functions that turn one filing's extracted data into output rows for each product. Messages
+# about skipped filings are collected as (counter, message) pairs rather than printed; the run
+# counts them by counter and writes the messages, in order, to the run's log.
+def index_filing_rows(row, extracted_data, table_rows, messages):
+    # Combine index data and extracted data
+    combined_data = dict(row)
+    combined_data.update(extracted_data)
+    return [combined_data]
+
+
+def schedule_c_filing_rows(row, extracted_data, table_rows, messages):
+    # Check if all Schedule C fields are empty
+    if any(value for key, value in extracted_data.items() if key in schedule_c_variable_set):
+        # Combine index data and non-empty Schedule C data
+        combined_data = dict(row)
+        combined_data.update(extracted_data)
+        return [combined_data]
+
+    messages.append(('empty_schedule_c', f"Skipping OBJECT_ID {row['OBJECT_ID']} due to empty Schedule C fields."))
+    return []
+
+
+def table_filing_rows(table_name, row, extracted_data, table_rows, messages):
+    return table_rows[table_name]
+
+
+# Function to hash a variable list and its aliases, so cached results are tied to the exact
+# variables extracted and to whether aliases were merged
+def variable_set_hash(variables, merge_aliases=False):
+    lines = [f"{var},{variable_aliases.get(var, '')}" for var in variables]
+    if merge_aliases:
+        lines.append('merge_aliases')
+    return hashlib.sha256('\n'.join(lines).encode('utf-8')).hexdigest()
+
+
+# Output products a parsed filing can be fanned out to. Products with variables have their
+# per-filing extracted data cached under a hash of the variable list.
+extraction_products = {
+    'index': {
+        'variables': all_variables,
+        'compiled_variables': all_variables_compiled,
+        'variables_hash': variable_set_hash(all_variables),
+        'merged_variables_hash': variable_set_hash(all_variables, merge_aliases=True),
+        'index_columns': index_columns,
+        'table': None,
+        'schedule': None,
+        'filing_rows': index_filing_rows,
+        'output_path': 'result/{year}/{year}_csv_index.csv',
+        'description': 'Data',
+    },
+    'schedule_c': {
+        'variables': schedule_c_variables,
+        'compiled_variables': schedule_c_variables_compiled,
+        'variables_hash': variable_set_hash(schedule_c_variables),
+        'merged_variables_hash': variable_set_hash(schedule_c_variables, merge_aliases=True),
+        'index_columns': index_columns,
+        'table': None,
+        'schedule': 'IRS990ScheduleC',
+        'filing_rows': schedule_c_filing_rows,
+        'output_path': 'result/{year}/schedule_c_{year}.csv',
+        'description': 'Schedule C data',
+    },
+    'recipient': {
+        'variables': [],
+        'compiled_variables': None,
+        'variables_hash': None,
+        'merged_variables_hash': None,
+        'index_columns': [],
+        'table': recipient_table,
+        'schedule': 'IRS990ScheduleI',
+        'filing_rows': functools.partial(table_filing_rows, 'recipient'),
+        'output_path': 'result/{year}/recipient_table_{year}.csv',
+        'description': 'Recipient data',
+    },
+    'compensation': {
+        'variables': [],
+        'compiled_variables': None,
+        'variables_hash': None,
+        'merged_variables_hash': None,
+        'index_columns': [],
+        'table': compensation_table,
+        'schedule': None,
+        'filing_rows': functools.partial(table_filing_rows, 'compensation'),
+        'output_path': 'result/{year}/compensation_{year}.csv',
+        'description': 'Part VII compensation data',
+    },
+    'schedule_r_related_org': {
+        'variables': [],
+        'compiled_variables': None,
+        'variables_hash': None,
+        'merged_variables_hash': None,
+        'index_columns': [],
+        'table': schedule_r_related_org_table,
+        'schedule': 'IRS990ScheduleR',
+        'filing_rows': functools.partial(table_filing_rows, 'schedule_r_related_org'),
+        'output_path': 'result/{year}/schedule_r_related_org_{year}.csv',
+        'description': 'Schedule R related organization data',
+    },
+}
+
+# Compiled variable tries for each combination of products and schema era, built on first use
+compiled_product_variables = {}
+
+
+def compile_product_variables(products, era=None):
+    key = (tuple(products), era)
+    if key not in compiled_product_variables:
+        variables = []
+        for product in products:
+            variables.extend(extraction_products[product]['variables'])
+        compiled_product_variables[key] = compile_variables(variables, era)
+    return compiled_product_variables[key]
+
+
+# Compiled table row tries for each combination of products and schema era (None if no product has a table)
+compiled_product_tables = {}
+
+
+def compile_product_tables(products, era=None):
+    key = (tuple(products), era)
+    if key not in compiled_product_tables:
+        tables = [extraction_products[product]['table'] for product in products
+                  if extraction_products[product]['table'] is not None]
+        compiled_product_tables[key] = compile_table_rows(tables, era) if tables else None
+    return compiled_product_tables[key]
+
+
+# Default location and size limit of the extraction cache. A published filing never changes,
+# so each filing's extracted data is stored under its OBJECT_ID and the hash of the variable
+# list, and is reused until the variable list changes. All entries live in one SQLite table,
+# which every worker reads and writes once per batch.
+extraction_cache_path = 'data/cache/extraction.sqlite'
+extraction_cache_max_mb = 4096
+
+
+# Function to create the extraction cache, before any worker opens it
+def create_extraction_cache(cache_path):
+    if os.path.dirname(cache_path) and not os.path.exists(os.path.dirname(cache_path)):
+        os.makedirs(os.path.dirname(cache_path))
+
+    with contextlib.closing(sqlite3.connect(cache_path)) as connection:
+        # Workers write their batches concurrently; WAL lets them read while another one writes
+        connection.execute('PRAGMA journal_mode=WAL')
+        connection.executescript('''
+            CREATE TABLE IF NOT EXISTS extraction_cache (
+                OBJECT_ID TEXT,
+                VARIABLES_HASH TEXT,
+                DATA TEXT,
+                LAST_USED REAL,
+                PRIMARY KEY (OBJECT_ID, VARIABLES_HASH)
+            );
+            CREATE INDEX IF NOT EXISTS extraction_cache_last_used ON extraction_cache (LAST_USED);
+        ''')
+
+
+def open_extraction_cache(cache_path):
+    return sqlite3.connect(cache_path, timeout=60)
+
+
+# Function to read the cached extracted data of a batch of filings, keyed by (OBJECT_ID, hash)
+def read_cache_entries(cache_path, object_ids, variables_hashes):
+    entries = {}
+    with contextlib.closing(open_extraction_cache(cache_path)) as connection:
+        # Stay well under SQLite's limit on the number of query parameters
+        for i in range(0, len(object_ids), 500):
+            chunk = object_ids[i:i + 500]
+            for object_id, variables_hash, data in connection.execute(
+                    'SELECT OBJECT_ID, VARIABLES_HASH, DATA FROM extraction_cache '
+                    f'WHERE OBJECT_ID IN ({",".join("?" * len(chunk))})', chunk):
+                if variables_hash in variables_hashes:
+                    entries[(object_id, variables_hash)] = json.loads(data)
+    return entries
+
+
+# Function to store a batch's newly extracted data and mark the entries it used as recently used,
+# in one transaction
+def write_cache_entries(cache_path, new_entries, used_keys):
+    now = time.time()
+    with contextlib.closing(open_extraction_cache(cache_path)) as connection, connection:
+        connection.executemany('INSERT OR REPLACE INTO extraction_cache VALUES (?, ?, ?, ?)',
+                               [(object_id, variables_hash, json.dumps(extracted_data), now)
+                                for (object_id, variables_hash), extracted_data in new_entries.items()])
+        connection.executemany('UPDATE extraction_cache SET LAST_USED = ? WHERE OBJECT_ID = ? AND VARIABLES_HASH = ?',
+                               [(now, object_id, variables_hash) for object_id, variables_hash in used_keys])
+
+
+# Function to remove the least recently used cache entries until the cache fits its size limit
+def evict_cache(cache_path, max_bytes):
+    if not os.path.exists(cache_path):
+        return 0
+
+    with contextlib.closing(open_extraction_cache(cache_path)) as connection, connection:
+        total_bytes = 0
+        evicted_keys = []
+        for object_id, variables_hash, size in connection.execute(
+                'SELECT OBJECT_ID, VARIABLES_HASH, LENGTH(DATA) FROM extraction_cache ORDER BY LAST_USED DESC'):
+            total_bytes += size
+            if total_bytes > max_bytes:
+                evicted_keys.append((object_id, variables_hash))
+        connection.executemany('DELETE FROM extraction_cache WHERE OBJECT_ID = ? AND VARIABLES_HASH = ?',
+                               evicted_keys)
+
+    return len(evicted_keys)
+
+
+# Function run by each worker: parse each filing in a batch once, fan it out to every
+# requested product, and time and count the batch's stages. Products whose extracted data is already
+# in the cache are served from it, and a filing is only parsed if some product still needs it.
+# Products tied to a schedule are skipped for filings without it. Filings whose schedules are
+# not known yet are byte-scanned first when every product is tied to a schedule, and are not
+# parsed at all if none of the products needs them; otherwise the schedules are read from the
+# parse. The schedules found either way are returned for the schedule index.
+def process_filing_batch(products, streaming, merge_aliases, backend, cache_path, columns, filing_tasks):
+    rows = {product: [] for product in products}
+    messages = []
+    failed_object_ids = []
+    scanned_schedules = {}
+    stats = RunStats()
+    scan_products = [product for product in products if extraction_products[product]['schedule'] is not None]
+
+    # The cached data of the whole batch is read in one query and its new entries written in one transaction
+    cache_hashes = {}
+    cached = {}
+    new_entries = {}
+    used_keys = []
+    if cache_path:
+        cache_hashes = {product: extraction_products[product]['merged_variables_hash' if merge_aliases else
+                                                              'variables_hash'] for product in products}
+        cache_hashes = {product: variables_hash for product, variables_hash in cache_hashes.items()
+                        if variables_hash is not None}
+        object_id_column = columns.index('OBJECT_ID')
+        with stats.stage('cache'):
+            cached = read_cache_entries(cache_path, [str(values[object_id_column]) for values, _, _ in filing_tasks],
+                                        set(cache_hashes.values()))
+
+    for values, filing_source, schedules in filing_tasks:
+        stats.count('filings')
+        row = dict(zip(columns, values))
+
+        extracted = {}
+        object_id = str(row['OBJECT_ID'])
+        for product, variables_hash in cache_hashes.items():
+            stats.count('cache_lookups')
+            if (object_id, variables_hash) in cached:
+                extracted[product] = cached[(object_id, variables_hash)]
+                used_keys.append((object_id, variables_hash))
+                stats.count('cache_hits')
+
+        table_rows = {}
+        parse_products = [product for product in products if product not in extracted]
+        if parse_products:
             try:
-                extracted_data = extract_variables_and_attr_from_xml(xml_file, all_variables)
-                # Combine index data and extracted data
-                combined_data = row.to_dict()  # Convert index row to dictionary
-                combined_data.update(extracted_data)  # Add extracted data
-                all_extracted_data.append(combined_data)  # Append to list
-            except ET.ParseError:
-                print(f"Error parsing {xml_file}.")
+                # A filing is only byte-scanned when every product left is tied to a schedule; if
+                # some product needs it parsed anyway, its schedules are read from the parse instead
+                if schedules is None and all(product in scan_products for product in parse_products):
+                    with stats.stage('scan'), open_filing(filing_source) as xml_file:
+                        schedules = scan_filing_schedules(xml_file)
+                    stats.count('schedule_scans')
+                    scanned_schedules[row['OBJECT_ID']] = schedules
+                if schedules is not None:
+                    parse_products = [product for product in parse_products
+                                      if product_needs_filing(product, schedules)]
+                if parse_products:
+                    parsed_schedules = set() if schedules is None else None
+                    with open_filing(filing_source) as xml_file:
+                        matches, table_rows = extract_filing(xml_file, row['OBJECT_ID'], parse_products, streaming,
+                                                             merge_aliases, backend, stats, parsed_schedules)
+                    stats.count('filings_parsed')
+                    stats.count('bytes_parsed', filing_size(filing_source))
+                    if parsed_schedules is not None:
+                        schedules = sorted(parsed_schedules)
+                        scanned_schedules[row['OBJECT_ID']] = schedules
+                        parse_products = [product for product in parse_products
+                                          if product_needs_filing(product, schedules)]
+            except xml_parse_errors + (zipfile.BadZipFile,):
+                messages.append(('parse_errors', f"Error parsing {filing_label(filing_source)}."))
+                failed_object_ids.append(str(row['OBJECT_ID']))
+                continue
             except FileNotFoundError:
-                print(f"File {xml_file} not found.")
-    
-    # Create a DataFrame from the list of dictionaries
-    combined_df = pd.DataFrame(all_extracted_data)
+                messages.append(('missing_files', f"File {filing_label(filing_source)} not found."))
+                failed_object_ids.append(str(row['OBJECT_ID']))
+                continue
+
+            with stats.stage('build'):
+                for product in parse_products:
+                    if extraction_products[product]['compiled_variables'] is None:
+                        continue
+                    extracted[product] = build_extracted_data(extraction_products[product]['compiled_variables'],
+                                                              matches, merge_aliases)
+            for product in parse_products:
+                if product in cache_hashes and product in extracted:
+                    new_entries[(object_id, cache_hashes[product])] = extracted[product]
+
+        needed_products = [product for product in products if product in extracted or product in parse_products]
+        if not needed_products:
+            stats.count('schedule_skips')
+        with stats.stage('build'):
+            for product in needed_products:
+                rows[product].extend(extraction_products[product]['filing_rows'](row, extracted.get(product),
+                                                                                 table_rows, messages))
+
+    if new_entries or used_keys:
+        with stats.stage('cache'):
+            write_cache_entries(cache_path, new_entries, used_keys)
+
+    # Count the batch's messages by counter (parse errors, missing files, ...) into its stats
+    for counter, message in messages:
+        stats.count(counter)
+
+    return os.getpid(), rows, messages, failed_object_ids, scanned_schedules, stats
+
+
+# Function to run one batch, under cProfile if a profile path is given for it
+def run_filing_batch(process_batch, filing_tasks, profile_path=None):
+    if profile_path is None:
+        return process_batch(filing_tasks)
+
+    profiler = cProfile.Profile()
+    result = profiler.runcall(process_batch, filing_tasks)
+    profiler.dump_stats(profile_path)
+    return result
+
+
+# Seconds between progress lines when the output is not a terminal (a terminal's line is redrawn more often)
+progress_interval = 30
+
+
+def format_duration(seconds):
+    if seconds == float('inf'):
+        return '?'
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours}:{minutes:02d}:{seconds:02d}"
+
+
+# Function to show how far the filing loop is: filings done, throughput, and the time left at
+# that rate. On a terminal the line is redrawn in place and finished by the final call;
+# otherwise a line is printed every progress_interval seconds so logs stay short.
+def show_progress(progress, done, total, final=False):
+    now = time.perf_counter()
+    terminal = sys.stdout.isatty()
+    if final and not terminal:
+        return
+    if not final and now - progress['printed'] < (0.5 if terminal else progress_interval):
+        return
+    progress['printed'] = now
+
+    elapsed = now - progress['start']
+    rate = done / elapsed if elapsed > 0 else 0.0
+    megabytes = run_stats.counts.get('bytes_parsed', 0) / 1024 / 1024
+    eta = (total - done) / rate if rate > 0 else float('inf')
+    line = (f"Processed {done} of {total} filings ({rate:.1f} filings/s, {megabytes / elapsed if elapsed > 0 else 0:.1f} MB/s), "
+            f"{'elapsed ' + format_duration(elapsed) if final else 'ETA ' + format_duration(eta)}.")
+    if terminal:
+        print('\r' + line, end='\n' if final else '', flush=True)
+    else:
+        print(line, flush=True)
+
+
+# Function to run every filing through the requested products, either in this process or
+# spread across a process pool in batches. Batch results are collected in submission order,
+# so the output rows are the same whatever the number of workers.
+# Each batch's rows are handed to write_rows(product, rows) as soon as the batch completes, the
+# schedules of the filings it scanned to write_schedules({OBJECT_ID: schedules}), and its messages
+# to write_messages(messages). The batch stats are merged into run_stats and progress is shown as
+# batches complete. With profile_path, every profile_every-th batch runs under cProfile and the
+# samples are combined into one pstats file there. A worker pool shared between runs can be
+# passed as executor; otherwise one is started for the run when workers > 1.
+def run_filing_tasks(products, columns, filing_tasks, write_rows, write_schedules=None, streaming=False, workers=1,
+                     batch_size=64, cache_path=None, merge_aliases=False, backend='etree', write_messages=None,
+                     profile_path=None, profile_every=10, executor=None):
+    batches = [filing_tasks[i:i + batch_size] for i in range(0, len(filing_tasks), batch_size)]
+    if cache_path:
+        create_extraction_cache(cache_path)
+    process_batch = functools.partial(run_filing_batch, functools.partial(
+        process_filing_batch, products, streaming, merge_aliases, backend, cache_path, columns))
+
+    profile_dir = tempfile.mkdtemp(prefix='profile_') if profile_path else None
+    batch_profile_paths = [os.path.join(profile_dir, f'batch_{i}.prof') if profile_dir and i % profile_every == 0
+                           else None for i in range(len(batches))]
+
+    all_failed_object_ids = set()
+    worker_stats = {}
+    progress = {'start': time.perf_counter(), 'printed': time.perf_counter()}
+    done = 0
+    own_executor = executor is None and workers > 1
+    if own_executor:
+        executor = ProcessPoolExecutor(max_workers=workers)
+    try:
+        batch_results = (executor.map(process_batch, batches, batch_profile_paths) if executor
+                         else map(process_batch, batches, batch_profile_paths))
+        for batch, (pid, rows, messages, failed_object_ids, scanned_schedules, stats) in zip(batches, batch_results):
+            if messages and write_messages:
+                write_messages([message for counter, message in messages])
+            with run_stats.stage('write'):
+                for product in products:
+                    write_rows(product, rows[product])
+                if scanned_schedules and write_schedules:
+                    write_schedules(scanned_schedules)
+            all_failed_object_ids.update(failed_object_ids)
+
+            run_stats.merge(stats)
+            worker_stats.setdefault(pid, RunStats()).merge(stats)
+            done += len(batch)
+            show_progress(progress, done, len(filing_tasks))
+    finally:
+        if own_executor:
+            executor.shutdown()
+    if filing_tasks:
+        show_progress(progress, done, len(filing_tasks), final=True)
+
+    if executor:
+        for pid, stats in sorted(worker_stats.items()):
+            print(f"Worker {pid}: {stats.counts.get('filings', 0)} filings, "
+                  f"{stats.counts.get('parse_errors', 0)} parse errors, {stats.counts.get('missing_files', 0)} "
+                  f"missing files, {stats.seconds.get('parse', 0.0):.1f} s parsing.")
+
+    if profile_dir:
+        profile_files = sorted(glob.glob(os.path.join(profile_dir, '*.prof')))
+        if profile_files:
+            pstats.Stats(*profile_files).dump_stats(profile_path)
+            print(f"Profiled {len(profile_files)} of {len(batches)} batches; the top functions by cumulative "
+                  f"time follow and the full profile is saved to {profile_path}.")
+            pstats.Stats(profile_path).sort_stats('cumulative').print_stats(15)
+        shutil.rmtree(profile_dir, ignore_errors=True)
+
+    return all_failed_object_ids
+
+
+# Function to read the OBJECT_IDs a product has already been extracted for in a year
+def read_manifest(product, year):
+    manifest_path = f'data/manifest/{product}_{year}.csv'
+    if not os.path.exists(manifest_path):
+        return set()
+    return set(pd.read_csv(manifest_path, dtype=str)['OBJECT_ID'])
+
+
+# Function to record the OBJECT_IDs a run extracted, replacing or extending the manifest
+def write_manifest(product, year, object_ids, append=False):
+    manifest_path = f'data/manifest/{product}_{year}.csv'
+    if not os.path.exists(os.path.dirname(manifest_path)):
+        os.makedirs(os.path.dirname(manifest_path))
+
+    append = append and os.path.exists(manifest_path)
+    pd.DataFrame({'OBJECT_ID': object_ids}).to_csv(manifest_path, mode='a' if append else 'w',
+                                                   header=not append, index=False)
+
+
+# Function to write one product's rows to its output CSV. With append, the rows are added to
+# the existing output; if they bring new columns the file is rewritten with the union of columns.
+def write_product_output(product, year, rows, append=False):
+    product_df = pd.DataFrame(rows)
 
     # Remove the "irs:" prefix from the column names
-    combined_df.columns = [col.replace('irs:', '') for col in combined_df.columns]
+    product_df.columns = [col.replace('irs:', '') for col in product_df.columns]
 
-    output_csv_path = f'result/{year}/{year}_csv_index.csv'
+    output_csv_path = extraction_products[product]['output_path'].format(year=year)
     if not os.path.exists(os.path.dirname(output_csv_path)):
         os.makedirs(os.path.dirname(output_csv_path))
 
-    combined_df.to_csv(output_csv_path, index=False)
+    try:
+        existing_columns = pd.read_csv(output_csv_path, nrows=0).columns.tolist() if append else None
+    except (FileNotFoundError, pd.errors.EmptyDataError):
+        existing_columns = None
 
-    print(f"Data extraction completed. Output saved to {output_csv_path}.")
+    if existing_columns is None:
+        product_df.to_csv(output_csv_path, index=False)
+    elif set(product_df.columns) <= set(existing_columns):
+        product_df.reindex(columns=existing_columns).to_csv(output_csv_path, mode='a', header=False, index=False)
+    else:
+        # Read the existing rows as plain strings so their values are written back unchanged
+        existing_df = pd.read_csv(output_csv_path, dtype=str, keep_default_na=False)
+        pd.concat([existing_df, product_df], ignore_index=True).to_csv(output_csv_path, index=False)
 
-    return combined_df
+    print(f"{extraction_products[product]['description']} extraction completed. Output saved to {output_csv_path}.")
 
+    return product_df
 
-# Function to extract Schedule C data from XML
-def extract_schedule_c_data(year):
-    index_csv_path = f'data/index_file/index_{year}.csv'
-    
-    # Download the index CSV if it does not exist
-    if not os.path.exists(index_csv_path):
-        index_csv_path = download_index_csv(year)
-    
-    index_df = pd.read_csv(index_csv_path)
 
-    # Filter the index DataFrame to include only rows with the specified form type
-    index_df = index_df[index_df['RETURN_TYPE'] == '990']
+# Writer that collects a product's rows and writes them to CSV at the end of the run
+class CsvProductWriter:
+    def __init__(self, product, year, append=False):
+        self.product = product
+        self.year = year
+        self.append = append
+        self.rows = []
 
-    xml_files_path_prefix = f'data/xml_files/{year}/'
+    def write_rows(self, rows):
+        self.rows.extend(rows)
 
-    # List to hold all extracted data that has non-empty Schedule C
-    valid_schedule_c_data = []
+    def close(self):
+        return write_product_output(self.product, self.year, self.rows, self.append)
 
-    if year < 2024:
-        for _, row in index_df.iterrows():
-            xml_folder_path = f"{xml_files_path_prefix}"
-            xml_file = f"{xml_folder_path}{row['OBJECT_ID']}_public.xml"
-            
-            # Download and extract the ZIP file if the XML folder does not exist
-            if not os.path.exists(xml_folder_path):
-                download_and_extract_zip_legacy(xml_files_path_prefix, year)
-            
-            try:
-                # Extract data for each row
-                extracted_data = extract_variables_and_attr_from_xml(xml_file, schedule_c_variables)
-                
-                # Check if all Schedule C fields are empty
-                if any(value for key, value in extracted_data.items() if key in schedule_c_variables):
-                    # Combine index data and non-empty Schedule C data
-                    combined_data = row.to_dict()  # Convert index row to dictionary
-                    combined_data.update(extracted_data)  # Add non-empty Schedule C data
-                    valid_schedule_c_data.append(combined_data)  # Append to list
-                else:
-                    print(f"Skipping OBJECT_ID {row['OBJECT_ID']} due to empty Schedule C fields.")
-            except ET.ParseError:
-                print(f"Error parsing {xml_file}.")
-            except FileNotFoundError:
-                print(f"File {xml_file} not found.")
+
+# Variables whose values are typed in Parquet output by the suffix of their element name
+typed_variable_set = set(all_variables) | set(schedule_c_variables)
+for product in extraction_products.values():
+    if product['table'] is not None:
+        typed_variable_set.update(product['table']['variables'])
+
+# IRS checkbox and boolean values for *Ind variables
+indicator_values = {'X': True, 'x': True, 'true': True, '1': True, 'false': False, '0': False}
+
+
+# Function to pick the Parquet type of an output column: *Amt and *Cnt variables are integers,
+# *Ind variables are booleans, and everything else is a dictionary-encoded string
+def parquet_column_type(column):
+    if column in typed_variable_set:
+        element_name = column.replace('/text()', '').rstrip('/').split('/')[-1]
+        if element_name.endswith(('Amt', 'Cnt')):
+            return pa.int64()
+        if element_name.endswith('Ind'):
+            return pa.bool_()
+    return pa.dictionary(pa.int32(), pa.string())
+
+
+# Function to convert one column of raw IRS strings to a typed Arrow array. Returns the array
+# and how many non-empty values could not be converted and were written as nulls.
+def to_parquet_array(values, arrow_type):
+    values = values.astype(object).where(values.notna() & (values != ''), None)
+    present = int(values.notna().sum())
+
+    if arrow_type == pa.int64():
+        numbers = pd.to_numeric(values, errors='coerce')
+        numbers = numbers.where(numbers == numbers.round())
+        array = pa.array(numbers.astype('Int64'), type=arrow_type)
+    elif arrow_type == pa.bool_():
+        array = pa.array([None if pd.isna(value) else indicator_values.get(value) for value in values],
+                         type=arrow_type)
     else:
-        for _, row in index_df.iterrows():
-            xml_folder_path = f"{xml_files_path_prefix}{row['XML_BATCH_ID']}/"
-            xml_file = f"{xml_folder_path}{row['OBJECT_ID']}_public.xml"
-            
-            # Download and extract the ZIP file if the XML folder does not exist
-            if not os.path.exists(xml_folder_path):
-                download_and_extract_zip(xml_files_path_prefix, row['XML_BATCH_ID'], year)
-            
-            try:
-                # Extract data for each row
-                extracted_data = extract_variables_and_attr_from_xml(xml_file, schedule_c_variables)
-                
-                # Check if all Schedule C fields are empty
-                if any(value for key, value in extracted_data.items() if key in schedule_c_variables):
-                    # Combine index data and non-empty Schedule C data
-                    combined_data = row.to_dict()  # Convert index row to dictionary
-                    combined_data.update(extracted_data)  # Add non-empty Schedule C data
-                    valid_schedule_c_data.append(combined_data)  # Append to list
-                else:
-                    print(f"Skipping OBJECT_ID {row['OBJECT_ID']} due to empty Schedule C fields.")
-            except ET.ParseError:
-                print(f"Error parsing {xml_file}.")
-            except FileNotFoundError:
-                print(f"File {xml_file} not found.")
-    
-    # Create a DataFrame from the list of dictionaries
-    valid_schedule_c_df = pd.DataFrame(valid_schedule_c_data)
+        array = pa.array([None if pd.isna(value) else str(value) for value in values],
+                         type=pa.string()).dictionary_encode()
 
-    # Remove the "irs:" prefix from the column names
-    valid_schedule_c_df.columns = [col.replace('irs:', '') for col in valid_schedule_c_df.columns]
+    return array, int(present - (len(array) - array.null_count))
 
-    output_schedule_c_csv_path = f'result/{year}/schedule_c_{year}.csv'
 
-    if not os.path.exists(os.path.dirname(output_schedule_c_csv_path)):
-        os.makedirs(os.path.dirname(output_schedule_c_csv_path))
+# Writer that streams a product's rows to a Parquet file, one row group per flush, so the
+# rows of a whole year are never held in memory. Columns are typed by parquet_column_type.
+# When rows bring columns the file does not have yet (attribute columns are only discovered
+# as filings are parsed), the part file written so far is closed and a new one is started with
+# the wider schema. On close, the row groups of all parts (after those of the existing file,
+# when appending) are copied once into the output with the final schema.
+class ParquetProductWriter:
+    def __init__(self, product, year, append=False, row_group_size=10000):
+        if pa is None:
+            raise ImportError("Parquet output requires pyarrow. Install it with 'pip install pyarrow'.")
 
-    valid_schedule_c_df.to_csv(output_schedule_c_csv_path, index=False)
+        self.product = product
+        csv_path = extraction_products[product]['output_path'].format(year=year)
+        self.output_path = os.path.splitext(csv_path)[0] + '.parquet'
+        self.temp_path = self.output_path + '.tmp'
+        self.row_group_size = row_group_size
+        self.pending = []
+        self.writer = None
+        self.part_paths = []
+        self.schema = pa.schema([])
+        self.conversion_errors = {}
 
-    print(f"Schedule C data extraction completed. Output saved to {output_schedule_c_csv_path}.")
+        if not os.path.exists(os.path.dirname(self.output_path)):
+            os.makedirs(os.path.dirname(self.output_path))
 
+        # Row groups of an existing output are carried over when appending
+        self.existing_path = self.output_path if append and os.path.exists(self.output_path) else None
+        if self.existing_path:
+            self.schema = pq.read_schema(self.existing_path)
 
+    def write_rows(self, rows):
+        self.pending.extend(rows)
+        if len(self.pending) >= self.row_group_size:
+            self.flush()
 
-# Function to extract recipient table from XML
-def extract_recipient_table(xml_file, object_id, recipient_variables):
-    tree = ET.parse(xml_file)
-    root = tree.getroot()
-    
-    recipient_data = []
-    # Find all elements that match the XPath for recipient tables
-    recipient_elements = root.findall('.//irs:RecipientTable', ns)
-    
-    for element in recipient_elements:
-        recipient = {'OBJECT_ID': object_id}
-        for var in recipient_variables:
-            # Remove '/text()' from the variable
-            xpath_expr = var.replace('/text()', '')
-
-            # Split the XPath expression and prepend 'irs:' to each part
-            xpath_parts = xpath_expr.split('/')
-            # Apply the 'irs:' prefix only to the actual XML elements
-            xpath_expr = '/'.join('irs:' + part for part in xpath_parts if part)
-
-            #print(xpath_expr)  # Debugging statement to verify the XPath expression
-            
-            recipient[var] = element.findtext(xpath_expr, default='', namespaces=ns)
-        recipient_data.append(recipient)
-    
-    return recipient_data
+    def flush(self):
+        if not self.pending:
+            return
+        product_df = pd.DataFrame(self.pending)
+        self.pending = []
+
+        # Remove the "irs:" prefix from the column names
+        product_df.columns = [col.replace('irs:', '') for col in product_df.columns]
+
+        new_fields = [pa.field(column, parquet_column_type(column)) for column in product_df.columns
+                      if column not in self.schema.names]
+        if self.writer is None or new_fields:
+            self.open_part(pa.schema(list(self.schema) + new_fields))
+
+        arrays = []
+        for field in self.schema:
+            if field.name in product_df.columns:
+                array, errors = to_parquet_array(product_df[field.name], field.type)
+                if errors:
+                    self.conversion_errors[field.name] = self.conversion_errors.get(field.name, 0) + errors
+            else:
+                array = pa.nulls(len(product_df), type=field.type)
+            arrays.append(array)
+        self.writer.write_table(pa.Table.from_arrays(arrays, schema=self.schema))
+
+    def open_part(self, schema):
+        if self.writer is not None:
+            self.writer.close()
+        self.schema = schema
+        part_path = f'{self.temp_path}.part{len(self.part_paths)}'
+        self.part_paths.append(part_path)
+        self.writer = pq.ParquetWriter(part_path, schema, use_dictionary=True)
+
+    def close(self):
+        self.flush()
+        if self.writer is not None:
+            self.writer.close()
+
+        source_paths = ([self.existing_path] if self.existing_path else []) + self.part_paths
+        if len(source_paths) == 1 and not self.existing_path:
+            # A single part already has the final schema
+            os.replace(self.part_paths[0], self.output_path)
+        else:
+            # No rows at all still leave an (empty) output, as the CSV writer does
+            with pq.ParquetWriter(self.temp_path, self.schema, use_dictionary=True) as writer:
+                for source_path in source_paths:
+                    source = pq.ParquetFile(source_path)
+                    for i in range(source.num_row_groups):
+                        row_group = source.read_row_group(i)
+                        arrays = [row_group.column(field.name) if field.name in row_group.schema.names
+                                  else pa.nulls(row_group.num_rows, type=field.type) for field in self.schema]
+                        writer.write_table(pa.Table.from_arrays(arrays, schema=self.schema))
+            for part_path in self.part_paths:
+                os.remove(part_path)
+            os.replace(self.temp_path, self.output_path)
 
+        for column, errors in sorted(self.conversion_errors.items()):
+            print(f"Wrote {errors} values of {column} that are not of its Parquet type as nulls.")
+        print(f"{extraction_products[self.product]['description']} extraction completed. "
+              f"Output saved to {self.output_path}.")
 
-def extract_recipient_data(year):
+
+# Function to open the output writer of a product for the chosen output format
+def open_product_writer(product, year, output_format='csv', append=False, row_group_size=10000):
+    if output_format == 'parquet':
+        return ParquetProductWriter(product, year, append, row_group_size)
+    return CsvProductWriter(product, year, append)
+
+
+# Stages in the order of a run, for the summary (stages run by workers are summed over them)
+run_stages = ['download', 'load_index', 'archive_index', 'cache', 'scan', 'parse', 'lookup', 'build', 'write',
+              'evict', 'close']
+
+
+# Function to write the machine-readable report of a run and print its summary: throughput,
+# counters, and the seconds spent in each stage
+def write_run_report(report_path, report):
+    if not os.path.exists(os.path.dirname(report_path)):
+        os.makedirs(os.path.dirname(report_path))
+    with open(report_path, 'w', encoding='utf-8') as file:
+        json.dump(report, file, indent=2)
+
+    counts = report['counts']
+    seconds = report['seconds']
+    print(f"Processed {counts.get('filings', 0)} filings in {report['elapsed_seconds']:.1f} s "
+          f"({report['filings_per_second']:.1f} filings/s, {report['megabytes_per_second']:.1f} MB/s parsed).")
+    problems = [f"{counts[counter]} {label}" for counter, label in
+                [('parse_errors', 'parse errors'), ('missing_files', 'missing files'),
+                 ('empty_schedule_c', 'filings with empty Schedule C fields')] if counts.get(counter)]
+    if problems:
+        print(f"Skipped {', '.join(problems)}; see {report['messages_path']}.")
+    if counts.get('schedule_skips'):
+        print(f"Skipped {counts['schedule_skips']} filings without the schedules the products need.")
+    if counts.get('cache_lookups'):
+        print(f"Extraction cache: {counts.get('cache_hits', 0)} of {counts['cache_lookups']} lookups served "
+              f"from {report['options']['cache_path']}.")
+    print("Seconds by stage: " + ', '.join(f"{stage} {seconds[stage]:.1f}" for stage in
+                                           sorted(seconds, key=lambda stage: run_stages.index(stage)
+                                                  if stage in run_stages else len(run_stages))) + '.')
+    print(f"Run report saved to {report_path}.")
+
+
+# Function to parse every filing of a year once and write each requested product's output
+# With incremental, the index CSV is re-downloaded and diffed against each product's manifest
+# of already extracted OBJECT_IDs; only new filings (and their ZIP batches) are fetched and
+# extracted, and their rows are appended to the existing outputs.
+# Every run is timed by stage and counted (see RunStats); the figures are written to a JSON
+# report (report_path, in which {year} stands for the year; by default
+# result/<year>/run_report_<year>.json) and the messages about skipped filings to a log beside
+# it. With profile_every, every profile_every-th batch of filings is sampled with cProfile into
+# result/<year>/profile_<year>.prof. Extracted variables are cached in the SQLite file
+# cache_path when one is given.
+# Runs over several years share their download session and worker pool (session, executor),
+# count the downloads made for the year ahead of its run (download_stats), and evict the cache
+# once at the end instead (cache_max_mb=None skips eviction).
+def extract_products(year, form_type, products, streaming=False, workers=1, batch_size=64, download_workers=4,
+                     cache_path=None, cache_max_mb=extraction_cache_max_mb, incremental=False,
+                     output_format='csv', row_group_size=10000, limit=None, sample=None, merge_aliases=False,
+                     backend=default_xml_backend, report_path=None, profile_every=None, session=None,
+                     executor=None, download_stats=None):
+    run_stats.reset()
+    if download_stats is not None:
+        run_stats.merge(download_stats)
+    started_at = time.time()
+    start = time.perf_counter()
     index_csv_path = f'data/index_file/index_{year}.csv'
     
-    # Download the index CSV if it does not exist
-    if not os.path.exists(index_csv_path):
-        index_csv_path = download_index_csv(year)
+    # Download the index CSV if it does not exist, or fetch the latest one for an incremental refresh
+    if incremental or not os.path.exists(index_csv_path):
+        with run_stats.stage('download'):
+            index_csv_path = download_index_csv(year, session, refresh=incremental)
     
-    index_df = pd.read_csv(index_csv_path)
+    # Read only the index columns the products copy into their rows, and only rows of the form type
+    columns = [column for column in index_columns
+               if column in filing_columns or
+               any(column in extraction_products[product]['index_columns'] for product in products)]
+    processed_object_ids = {product: set() for product in products}
+    with run_stats.stage('load_index'):
+        if incremental:
+            processed_object_ids = {product: read_manifest(product, year) for product in products}
+            already_processed = set.intersection(*processed_object_ids.values())
+            index_df = load_index(index_csv_path, form_type, columns, already_processed, limit, sample)
+            print(f"Found {len(index_df)} new filings in the index for year {year}.")
+        else:
+            index_df = load_index(index_csv_path, form_type, columns, limit=limit, sample=sample)
+    run_stats.count('index_rows', len(index_df))
 
-    # Filter the index DataFrame to include only rows with the specified form type
-    index_df = index_df[index_df['RETURN_TYPE'] == '990']
+    filing_tasks = list_filing_tasks(index_df, year, download_workers, session)
 
-    all_recipient_data = []
+    writers = {product: open_product_writer(product, year, output_format, incremental, row_group_size)
+               for product in products}
 
-    xml_files_path_prefix = f'data/xml_files/{year}/'
+    def write_rows(product, rows):
+        done = processed_object_ids[product]
+        rows = [row for row in rows if str(row['OBJECT_ID']) not in done]
+        writers[product].write_rows(rows)
+        run_stats.count(f'rows_{product}', len(rows))
 
-    if year >= 2024:
-        for index, row in index_df.iterrows():
-            xml_folder_path = f"{xml_files_path_prefix}{row['XML_BATCH_ID']}/"
-            xml_file = f"{xml_folder_path}{row['OBJECT_ID']}_public.xml"
-            
-            # Download and extract the ZIP file if the XML folder does not exist
-            if not os.path.exists(xml_folder_path):
-                download_and_extract_zip(xml_files_path_prefix, row['XML_BATCH_ID'], year)
-            
-            try:
-                recipient_data = extract_recipient_table(xml_file, row['OBJECT_ID'], recipient_variables)
-                all_recipient_data.extend(recipient_data)
-            except ET.ParseError:
-                print(f"Error parsing {xml_file}.")
-            except FileNotFoundError:
-                print(f"File {xml_file} not found.")
+    report_path = (report_path or 'result/{year}/run_report_{year}.json').format(year=year)
+    messages_path = os.path.splitext(report_path)[0] + '.log'
+    if not os.path.exists(os.path.dirname(messages_path)):
+        os.makedirs(os.path.dirname(messages_path))
+
+    def write_messages(messages):
+        messages_file.write(''.join(message + '\n' for message in messages))
+
+    # Filings the schedule index shows have none of the schedules the products need are skipped unread
+    schedule_index = read_schedule_index(year)
+    filing_tasks = [(values, filing_source, schedule_index.get(object_id))
+                    for (values, filing_source), object_id in zip(filing_tasks, index_df['OBJECT_ID'])]
+    needed_filing_tasks = [task for task in filing_tasks
+                           if any(product_needs_filing(product, task[2]) for product in products)]
+    if len(needed_filing_tasks) < len(filing_tasks):
+        run_stats.count('schedule_index_skips', len(filing_tasks) - len(needed_filing_tasks))
+        print(f"Skipped {len(filing_tasks) - len(needed_filing_tasks)} filings the schedule index shows "
+              f"are without the schedules the products need.")
+
+    profile_path = f'result/{year}/profile_{year}.prof' if profile_every else None
+    with open(messages_path, 'w', encoding='utf-8') as messages_file:
+        failed_object_ids = run_filing_tasks(products, list(index_df.columns), needed_filing_tasks, write_rows,
+                                             functools.partial(append_schedule_index, year), streaming, workers,
+                                             batch_size, cache_path, merge_aliases, backend, write_messages,
+                                             profile_path, profile_every, executor)
+
+    if cache_path and cache_max_mb is not None:
+        with run_stats.stage('evict'):
+            evicted = evict_cache(cache_path, cache_max_mb * 1024 * 1024)
+        if evicted:
+            print(f"Evicted {evicted} entries from the extraction cache.")
+
+    product_dfs = {}
+    with run_stats.stage('close'):
+        for product in products:
+            product_dfs[product] = writers[product].close()
+
+            # Filings that failed are left out of the manifest so the next refresh retries them
+            done = processed_object_ids[product]
+            new_object_ids = [object_id for object_id in index_df['OBJECT_ID']
+                              if object_id not in done and object_id not in failed_object_ids]
+            write_manifest(product, year, new_object_ids, append=incremental)
+
+    elapsed = time.perf_counter() - start
+    write_run_report(report_path, {
+        'year': year,
+        'form_type': form_type,
+        'products': products,
+        'options': {'streaming': streaming, 'workers': workers, 'batch_size': batch_size, 'cache_path': cache_path,
+                    'incremental': incremental, 'output_format': output_format, 'limit': limit, 'sample': sample,
+                    'merge_aliases': merge_aliases, 'backend': backend},
+        'started_at': time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(started_at)),
+        'elapsed_seconds': elapsed,
+        'filings_per_second': run_stats.counts.get('filings', 0) / elapsed,
+        'megabytes_per_second': run_stats.counts.get('bytes_parsed', 0) / 1024 / 1024 / elapsed,
+        'seconds': dict(run_stats.seconds),
+        'counts': dict(run_stats.counts),
+        'messages_path': messages_path,
+        'profile_path': profile_path,
+    })
+
+    return product_dfs
+
+
+# Function to download a year's index CSV and the ZIP batches holding its filings of the form
+# type, ahead of extracting the year. Returns the stats of the downloads for its run report.
+def prefetch_year(year, form_type, download_workers=4, session=None, limit=None, sample=None):
+    stats = RunStats()
+    index_csv_path = f'data/index_file/index_{year}.csv'
+    with stats.stage('download'):
+        if not os.path.exists(index_csv_path):
+            download_index_csv(year, session, stats=stats)
+        index_df = load_index(index_csv_path, form_type, filing_columns, limit=limit, sample=sample)
+        download_year_filings(index_df, year, download_workers, session, stats)
+    return stats
+
+
+# Column of the tax year a filing reports in its header
+tax_year_column = 'ReturnHeader/TaxYr/text()'
+
+
+# Function to get the path of a product's output for a year in the given format
+def product_output_path(product, year, output_format='csv'):
+    output_path = extraction_products[product]['output_path'].format(year=year)
+    if output_format == 'parquet':
+        return os.path.splitext(output_path)[0] + '.parquet'
+    return output_path
+
+
+# Function to get the tax year of each tax period (YYYYMM, the month the period ends), which is
+# the year the period began: a period ending in December began that year, any other the year before
+def tax_period_start_year(tax_periods):
+    period_end_year = pd.to_numeric(tax_periods.str[:4], errors='coerce')
+    period_start_year = period_end_year - (tax_periods.str[4:6] != '12')
+    return period_start_year.astype('Int64').astype(str).replace('<NA>', '')
+
+
+# Function to pick the filing kept in the panel for each EIN and tax year, from the key columns
+# of the yearly main data. Returns {(index year, OBJECT_ID): tax year}.
+def panel_filings(years, output_format='csv'):
+    key_columns = ['EIN', 'TAX_PERIOD', 'SUB_DATE', 'OBJECT_ID', tax_year_column]
+
+    keys = []
+    for year in years:
+        output_path = product_output_path('index', year, output_format)
+        if output_format == 'parquet':
+            columns = [column for column in key_columns if column in pq.read_schema(output_path).names]
+            year_keys = pq.read_table(output_path, columns=columns).to_pandas()
+            year_keys = year_keys.astype(object).where(year_keys.notna(), '').astype(str)
+        else:
+            year_keys = pd.read_csv(output_path, usecols=lambda column: column in key_columns, dtype=str,
+                                    keep_default_na=False)
+        year_keys = year_keys.reindex(columns=key_columns, fill_value='')
+        year_keys['INDEX_YEAR'] = year
+        keys.append(year_keys)
+    keys_df = pd.concat(keys, ignore_index=True)
+
+    keys_df['TAX_YEAR'] = keys_df[tax_year_column].where(keys_df[tax_year_column] != '',
+                                                         tax_period_start_year(keys_df['TAX_PERIOD']))
+
+    kept = keys_df.sort_values(['SUB_DATE', 'INDEX_YEAR', 'OBJECT_ID'], kind='stable').drop_duplicates(
+        ['EIN', 'TAX_YEAR'], keep='last')
+    return dict(zip(zip(kept['INDEX_YEAR'], kept['OBJECT_ID']), kept['TAX_YEAR']))
+
+
+# Function to combine the yearly main data outputs into one panel with a row per EIN and tax
+# year, saved as result/panel_<first year>_<last year>. A return that is filed again (amended,
+# or re-processed) shows up in the index of more than one year; the copy submitted last is
+# kept. The tax year is the TaxYr a filing reports, or, if it has none, the year its tax period
+# (TAX_PERIOD, the YYYYMM the period ends) began. The panel is written a year at a time, so
+# only one year's output is in memory at once.
+def write_panel(years, output_format='csv'):
+    kept = panel_filings(years, output_format)
+    panel_path = f"result/panel_{years[0]}_{years[-1]}.{'parquet' if output_format == 'parquet' else 'csv'}"
+    panel_rows = 0
+
+    if output_format == 'parquet':
+        year_schema = pa.unify_schemas([pq.read_schema(product_output_path('index', year, output_format))
+                                        for year in years])
+        schema = pa.schema([year_schema.field('EIN'), pa.field('TAX_YEAR', pa.string()),
+                            pa.field('INDEX_YEAR', pa.int64())] +
+                           [field for field in year_schema if field.name != 'EIN'])
+        with pq.ParquetWriter(panel_path, schema, use_dictionary=True) as writer:
+            for year in years:
+                table = pq.read_table(product_output_path('index', year, output_format))
+                object_ids = table['OBJECT_ID'].cast(pa.string()).to_pylist()
+                table = table.filter(pa.array([(year, object_id) in kept for object_id in object_ids]))
+                object_ids = table['OBJECT_ID'].cast(pa.string()).to_pylist()
+                columns = {'TAX_YEAR': pa.array([kept[(year, object_id)] for object_id in object_ids], pa.string()),
+                           'INDEX_YEAR': pa.array([year] * len(table), pa.int64())}
+                arrays = [columns[field.name] if field.name in columns else
+                          table[field.name] if field.name in table.column_names else
+                          pa.nulls(len(table), type=field.type) for field in schema]
+                writer.write_table(pa.Table.from_arrays(arrays, schema=schema))
+                panel_rows += len(table)
     else:
-        for index, row in index_df.iterrows():
-            xml_folder_path = f"{xml_files_path_prefix}"
-            xml_file = f"{xml_folder_path}{row['OBJECT_ID']}_public.xml"
-            
-            # Download and extract the ZIP file if the XML folder does not exist
-            if not os.path.exists(xml_folder_path):
-                download_and_extract_zip_legacy(xml_files_path_prefix, year)
-            
-            try:
-                recipient_data = extract_recipient_table(xml_file, row['OBJECT_ID'], recipient_variables)
-                all_recipient_data.extend(recipient_data)
-            except ET.ParseError:
-                print(f"Error parsing {xml_file}.")
-            except FileNotFoundError:
-                print(f"File {xml_file} not found.")
-    
-    recipient_df = pd.DataFrame(all_recipient_data)
+        year_columns = [pd.read_csv(product_output_path('index', year), nrows=0).columns.tolist() for year in years]
+        columns = ['EIN', 'TAX_YEAR', 'INDEX_YEAR']
+        for column in (column for year_column_list in year_columns for column in year_column_list):
+            if column not in columns:
+                columns.append(column)
+        for i, year in enumerate(years):
+            year_df = pd.read_csv(product_output_path('index', year), dtype=str, keep_default_na=False)
+            year_df = year_df[[(year, object_id) in kept for object_id in year_df['OBJECT_ID']]]
+            year_df['TAX_YEAR'] = [kept[(year, object_id)] for object_id in year_df['OBJECT_ID']]
+            year_df['INDEX_YEAR'] = year
+            year_df.reindex(columns=columns).to_csv(panel_path, mode='a' if i else 'w', header=not i, index=False)
+            panel_rows += len(year_df)
+
+    print(f"Panel of {panel_rows} filings by EIN and tax year saved to {panel_path}.")
+    return panel_path
+
+
+# Function to extract several years in one pipeline. The downloads of each year run in a
+# background thread while the year before it is extracted, and all years share one download
+# session, worker pool and extraction cache (evicted once, at the end). Each year gets its own
+# outputs and run report; with panel, the yearly main data is also combined by EIN and tax year.
+# Incremental runs fetch each year's new filings in its own run instead, as only those are needed.
+def extract_years(years, form_type, products, panel=False, workers=1, download_workers=4,
+                  cache_path=None, cache_max_mb=extraction_cache_max_mb, incremental=False,
+                  limit=None, sample=None, **options):
+    if panel and 'index' not in products:
+        raise ValueError("The panel is built from the main data, so --panel needs the index product.")
+
+    session = create_download_session(download_workers)
+    executor = ProcessPoolExecutor(max_workers=workers) if workers > 1 else None
+    if executor:
+        # Start the workers now, so they are not forked while the download thread is running
+        executor.submit(os.getpid).result()
+    downloader = ThreadPoolExecutor(max_workers=1)
+
+    def prefetch(year):
+        if incremental:
+            return None
+        return downloader.submit(prefetch_year, year, form_type, download_workers, session, limit, sample)
+
+    try:
+        prefetches = {years[0]: prefetch(years[0])}
+        for i, year in enumerate(years):
+            if i + 1 < len(years):
+                prefetches[years[i + 1]] = prefetch(years[i + 1])
+            prefetched = prefetches.pop(year)
+            if len(years) > 1:
+                print(f"Extracting year {year}.")
+            extract_products(year, form_type, products, workers=workers, download_workers=download_workers,
+                             cache_path=cache_path, cache_max_mb=None, incremental=incremental, limit=limit,
+                             sample=sample, session=session, executor=executor,
+                             download_stats=prefetched.result() if prefetched else None, **options)
+    finally:
+        downloader.shutdown(cancel_futures=True)
+        if executor:
+            executor.shutdown()
+
+    if cache_path:
+        evicted = evict_cache(cache_path, cache_max_mb * 1024 * 1024)
+        if evicted:
+            print(f"Evicted {evicted} entries from the extraction cache.")
+
+    if panel:
+        write_panel(years, options.get('output_format', 'csv'))
+
+
+def extract_index_data(year, form_type, **options):
+    return extract_products(year, form_type, ['index'], **options)['index']
+
+
+# Function to extract Schedule C data from XML
+def extract_schedule_c_data(year, **options):
+    extract_products(year, '990', ['schedule_c'], **options)
+
+
+# Function to extract the rows of a repeating table (such as the recipient table) from XML
+def extract_table(xml_file, object_id, table, backend='etree'):
+    tree = xml_backends[backend]['parse'](xml_file)
+    root = tree.getroot()
+
+    table_data = []
+    # Only the subtrees on the table's row prefixes are searched for rows
+    match_table_rows(root, compile_table_rows([table])['trie'],
+                     lambda table_name, element: table_data.append(extract_table_row(element, object_id, table)))
 
+    return table_data
+
+
+# Function to walk a filing with iterparse instead of building the whole ElementTree.
+# Variables are matched against the compiled trie as their elements close, and each row of
+# the compiled tables is handed to on_row(table name, element) once complete. Every finished
+# subtree is then detached from its parent, so peak memory stays bounded however large the
+# document is. on_root, if given, picks the compiled variables and tables from the root element,
+# and the schedules among the root's grandchildren (ReturnData's children) are added to schedules.
+def iterparse_filing(xml_file, compiled_variables=None, compiled_tables=None, on_row=None, on_root=None,
+                     backend='etree', schedules=None):
+    matches = {}
+    element_stack = []
+    node_stack = []
+    row_node_stack = []
+    # Greater than zero while inside a row, whose subtree is kept until the row closes
+    row_depth = 0
+
+    for event, element in xml_backends[backend]['iterparse'](xml_file, events=('start', 'end')):
+        if event == 'start':
+            if not element_stack:
+                if on_root is not None:
+                    compiled_variables, compiled_tables = on_root(element)
+                node = compiled_variables['trie'] if compiled_variables is not None else None
+                row_node = compiled_tables['trie'] if compiled_tables is not None else None
+            else:
+                parent_node = node_stack[-1]
+                node = parent_node['children'].get(element.tag) if parent_node is not None else None
+                parent_row_node = row_node_stack[-1]
+                row_node = parent_row_node['children'].get(element.tag) if parent_row_node is not None else None
+                if row_node is not None and row_node['vars']:
+                    row_depth += 1
+                if schedules is not None and len(element_stack) == 2:
+                    collect_schedule(element, schedules)
+            element_stack.append(element)
+            node_stack.append(node)
+            row_node_stack.append(row_node)
+            continue
+
+        element_stack.pop()
+        node = node_stack.pop()
+        row_node = row_node_stack.pop()
+        if node is not None:
+            for var in node['vars']:
+                # Keep the first match in document order, same as root.find()
+                if var not in matches:
+                    matches[var] = element
+
+        if not element_stack:
+            continue
+        if row_node is not None and row_node['vars']:
+            for table_name in row_node['vars']:
+                on_row(table_name, element)
+            row_depth -= 1
+        if row_depth == 0:
+            element_stack[-1].remove(element)
+
+    return matches
+
+
+def stream_variables_and_attr_from_xml(xml_file, compiled_variables, backend='etree'):
+    matches = iterparse_filing(xml_file, compiled_variables=compiled_variables, backend=backend)
+    return build_extracted_data(compiled_variables, matches)
+
+
+def stream_table(xml_file, object_id, table, backend='etree'):
+    table_data = []
+    iterparse_filing(xml_file, compiled_tables=compile_table_rows([table]),
+                     on_row=lambda table_name, element: table_data.append(
+                         extract_table_row(element, object_id, table)), backend=backend)
+    return table_data
+
+
+def extract_recipient_data(year, **options):
+    extract_products(year, '990', ['recipient'], **options)
+
+
+# Default location of the filing store: an SQLite table of every filing in the indexes of the
+# stored years, with its EIN, tax year and return type and where it is in the downloaded archives
+filing_store_path = 'data/filing_store.sqlite'
+
+# Index columns kept in the filing store
+store_columns = ['OBJECT_ID', 'EIN', 'TAX_PERIOD', 'RETURN_TYPE', 'TAXPAYER_NAME', 'SUB_DATE', 'XML_BATCH_ID']
+
+
+# Function to open the filing store, creating its table and indexes on first use
+def open_filing_store(store_path=filing_store_path):
+    if os.path.dirname(store_path) and not os.path.exists(os.path.dirname(store_path)):
+        os.makedirs(os.path.dirname(store_path))
+
+    connection = sqlite3.connect(store_path)
+    connection.executescript('''
+        CREATE TABLE IF NOT EXISTS filings (
+            OBJECT_ID TEXT PRIMARY KEY,
+            EIN TEXT,
+            TAX_PERIOD TEXT,
+            TAX_YEAR TEXT,
+            RETURN_TYPE TEXT,
+            TAXPAYER_NAME TEXT,
+            SUB_DATE TEXT,
+            XML_BATCH_ID TEXT,
+            INDEX_YEAR INTEGER,
+            ARCHIVE TEXT,
+            MEMBER TEXT
+        );
+        CREATE INDEX IF NOT EXISTS filings_ein_tax_year ON filings (EIN, TAX_YEAR);
+        CREATE INDEX IF NOT EXISTS filings_index_year ON filings (INDEX_YEAR);
+    ''')
+    return connection
+
+
+# Function to (re)build the filing store entries of the given years from their index CSVs
+# (downloaded if missing) and the ZIP archives on disk. Every return type is stored. A filing
+# that is not in any archive yet is stored with the path of its loose XML file instead (and
+# no ARCHIVE); lookups download its ZIP batch when they need it.
+def build_filing_store(years, store_path=filing_store_path, session=None):
+    with contextlib.closing(open_filing_store(store_path)) as connection:
+        for year in years:
+            index_csv_path = f'data/index_file/index_{year}.csv'
+            if not os.path.exists(index_csv_path):
+                index_csv_path = download_index_csv(year, session)
+            index_df = pd.read_csv(index_csv_path, usecols=lambda column: column in store_columns, dtype=str,
+                                   keep_default_na=False).reindex(columns=store_columns, fill_value='')
+
+            xml_files_path_prefix = f'data/xml_files/{year}/'
+            filing_index = build_filing_index(xml_files_path_prefix)
+            if year < 2024:
+                xml_files = xml_files_path_prefix + index_df['OBJECT_ID'] + '_public.xml'
+            else:
+                xml_files = (xml_files_path_prefix + index_df['XML_BATCH_ID'] + '/' + index_df['OBJECT_ID'] +
+                             '_public.xml')
+            filing_sources = [filing_index.get(object_id, (None, xml_file))
+                              for object_id, xml_file in zip(index_df['OBJECT_ID'], xml_files)]
+
+            index_df['TAX_YEAR'] = tax_period_start_year(index_df['TAX_PERIOD'])
+            index_df['INDEX_YEAR'] = year
+            index_df['ARCHIVE'] = [archive for archive, member in filing_sources]
+            index_df['MEMBER'] = [member for archive, member in filing_sources]
+
+            with connection:
+                connection.execute('DELETE FROM filings WHERE INDEX_YEAR = ?', (year,))
+                connection.executemany(
+                    f"INSERT OR REPLACE INTO filings ({', '.join(index_df.columns)}) "
+                    f"VALUES ({', '.join('?' * len(index_df.columns))})",
+                    index_df.itertuples(index=False, name=None))
+            print(f"Stored {len(index_df)} filings of year {year} ({len(filing_index)} in archives on disk) "
+                  f"in {store_path}.")
+
+
+# Function to normalise an EIN to the 9 digits of the index CSV (dashes removed, leading zeros kept)
+def normalize_ein(ein):
+    return str(ein).replace('-', '').strip().zfill(9)
+
+
+# Function to find filings in the store by EIN, tax year, return type and OBJECT_ID. Each
+# argument is a list of accepted values, or None to accept any.
+def find_filings(eins=None, tax_years=None, return_types=None, object_ids=None, store_path=filing_store_path):
+    conditions = []
+    parameters = []
+    for column, values in [('EIN', [normalize_ein(ein) for ein in eins] if eins else None),
+                           ('TAX_YEAR', [str(tax_year) for tax_year in tax_years] if tax_years else None),
+                           ('RETURN_TYPE', return_types), ('OBJECT_ID', object_ids)]:
+        if values:
+            conditions.append(f"{column} IN ({', '.join('?' * len(values))})")
+            parameters.extend(values)
+
+    query = 'SELECT * FROM filings' + (' WHERE ' + ' AND '.join(conditions) if conditions else '')
+    with contextlib.closing(open_filing_store(store_path)) as connection:
+        return pd.read_sql_query(query + ' ORDER BY EIN, TAX_YEAR, SUB_DATE', connection, params=parameters,
+                                 dtype=str)
+
+
+# Compiled variable tries for the variable lists of lookups, by list and schema era
+compiled_lookup_variables = {}
+
+
+# Function to extract the given variables from one filing, compiled for the schema era of its returnVersion
+def extract_filing_variables(xml_file, variables, merge_aliases=False, backend='etree'):
+    root = xml_backends[backend]['parse'](xml_file).getroot()
+    key = (tuple(variables), schema_era(root.get('returnVersion')))
+    if key not in compiled_lookup_variables:
+        compiled_lookup_variables[key] = compile_variables(variables, key[1])
+
+    matches = {}
+    match_compiled_variables(root, compiled_lookup_variables[key]['trie'], matches)
+    return build_extracted_data(compiled_lookup_variables[key], matches, merge_aliases)
+
+
+# Function to extract variables (by default the main data variables) from just the filings the
+# store finds for the given EINs, tax years, return types and OBJECT_IDs. The ZIP batches of
+# matching filings that are not on disk yet are downloaded first, and indexed into the store.
+# Returns one row per filing: its store entry followed by the extracted variables.
+def lookup_filings(eins=None, tax_years=None, return_types=None, object_ids=None, variables=None,
+                   store_path=filing_store_path, merge_aliases=False, backend=default_xml_backend,
+                   download_workers=4):
+    variables = variables or all_variables
+    filings_df = find_filings(eins, tax_years, return_types, object_ids, store_path)
+
+    # Fetch the batches of matching filings that are neither in an archive nor a loose file on disk.
+    # Legacy indexes do not say which batch a filing is in, so all of the year's batches are
+    # fetched (complete ones already on disk are skipped).
+    missing_df = filings_df[filings_df['ARCHIVE'].isna() &
+                            ~filings_df['MEMBER'].map(os.path.exists).astype(bool)]
+    if not missing_df.empty:
+        session = create_download_session(download_workers)
+        downloaded_years = []
+        for year, year_df in missing_df.groupby('INDEX_YEAR'):
+            year = int(year)
+            stats = RunStats()
+            if year < 2024:
+                download_zip_legacy(f'data/xml_files/{year}/', year, download_workers, session, stats)
+            else:
+                download_year_filings(year_df[year_df['XML_BATCH_ID'].fillna('') != ''], year, download_workers,
+                                      session, stats)
+            if stats.counts.get('files_downloaded'):
+                downloaded_years.append(year)
+        # Index the new archives; filings that are in none of them stay missing
+        if downloaded_years:
+            build_filing_store(downloaded_years, store_path, session)
+            filings_df = find_filings(eins, tax_years, return_types, object_ids, store_path)
+
+    entry_columns = ['EIN', 'TAX_YEAR', 'TAX_PERIOD', 'RETURN_TYPE', 'OBJECT_ID', 'TAXPAYER_NAME', 'SUB_DATE',
+                     'INDEX_YEAR']
+    rows = []
+    for filing in filings_df.to_dict('records'):
+        filing_source = (filing['ARCHIVE'], filing['MEMBER']) if pd.notna(filing['ARCHIVE']) else filing['MEMBER']
+        row = {column: filing[column] for column in entry_columns}
+        try:
+            with open_filing(filing_source) as xml_file:
+                row.update(extract_filing_variables(xml_file, variables, merge_aliases, backend))
+        except xml_parse_errors + (zipfile.BadZipFile,):
+            print(f"Error parsing {filing_label(filing_source)}.")
+        except FileNotFoundError:
+            print(f"File {filing_label(filing_source)} not found.")
+        rows.append(row)
+
+    lookup_df = pd.DataFrame(rows, columns=None if rows else entry_columns)
     # Remove the "irs:" prefix from the column names
-    recipient_df.columns = [col.replace('irs:', '') for col in recipient_df.columns]
+    lookup_df.columns = [col.replace('irs:', '') for col in lookup_df.columns]
+    return lookup_df
 
-    output_recipient_csv_path = f'result/{year}/recipient_table_{year}.csv'
-    if not os.path.exists(os.path.dirname(output_recipient_csv_path)):
-        os.makedirs(os.path.dirname(output_recipient_csv_path))
-    
-    recipient_df.to_csv(output_recipient_csv_path, index=False)
 
-    print(f"Recipient data extraction completed. Output saved to {output_recipient_csv_path}.")
+# Function to read a --years value: a range such as 2018-2024, a comma-separated list, or both
+def parse_years(value):
+    years = set()
+    for part in value.split(','):
+        if '-' in part:
+            first_year, last_year = part.split('-')
+            years.update(range(int(first_year), int(last_year) + 1))
+        else:
+            years.add(int(part))
+    return sorted(years)
 
 
-def main(year, form_type, recipient, schedule):
-    if year < 2018:
+def main(years, form_type, recipient, schedule, products=None, panel=False, **options):
+    if isinstance(years, int):
+        years = [years]
+    if min(years) < 2018:
         raise ValueError("Year must be 2018 or later. IRS does not have data before 2018.")
     if form_type != '990':
         raise ValueError("Only form 990 is supported in this version.")
 
-    if recipient:
-        extract_recipient_data(year)
+    if options.get('workers', 1) < 1:
+        raise ValueError("Number of workers must be at least 1.")
+    if options.get('profile_every') is not None and options['profile_every'] < 1:
+        raise ValueError("--profile-every must be at least 1.")
+    if options.get('backend', default_xml_backend) not in xml_backends:
+        raise ValueError(f"XML backend {options['backend']} is not available. "
+                         f"Choose from {list(xml_backends)} (lxml needs 'pip install lxml').")
+
+    if products:
+        unknown_products = [product for product in products if product not in extraction_products]
+        if unknown_products:
+            raise ValueError(f"Unknown products {unknown_products}. Choose from {list(extraction_products)}.")
+    elif recipient:
+        products = ['recipient']
     elif schedule == '':
-        extract_index_data(year, form_type)
+        products = ['index']
     elif schedule == 'C':
-        extract_schedule_c_data(year)
+        products = ['schedule_c']
+    else:
+        raise ValueError(f"Schedule {schedule} is not supported. Use --products for the other products.")
+
+    extract_years(years, form_type, products, panel, **options)
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Extract IRS form data from XML files.")
     parser.add_argument('--year', type=int, default=2024, help='The year of the data to process.')
+    parser.add_argument('--years', type=parse_years, default=None, help='Several years to process in one run, e.g. 2018-2024 or 2019,2021 (overrides --year).')
+    parser.add_argument('--panel', action='store_true', default=False, help='Also combine the yearly main data into one panel file keyed by EIN and tax year.')
+    parser.add_argument('--build-store', action='store_true', default=False, help='Index every filing of --year/--years by EIN, tax year and return type into the filing store instead of extracting.')
+    parser.add_argument('--store', type=str, default=filing_store_path, help='Path of the SQLite filing store.')
+    parser.add_argument('--ein', type=lambda value: value.split(','), default=None, help='Look up the filings of these comma-separated EINs in the filing store and extract them.')
+    parser.add_argument('--tax-year', type=lambda value: value.split(','), default=None, help='Only look up filings of these comma-separated tax years.')
+    parser.add_argument('--return-type', type=lambda value: value.split(','), default=None, help='Only look up filings of these comma-separated return types (e.g. 990,990EZ).')
+    parser.add_argument('--object-id', type=lambda value: value.split(','), default=None, help='Look up these comma-separated OBJECT_IDs in the filing store and extract them.')
+    parser.add_argument('--variables', type=lambda value: value.split(','), default=None, help='Comma-separated variables to extract in a lookup (default: the main data variables).')
+    parser.add_argument('--output', type=str, default=None, help='CSV file for the lookup results (default: print them).')
     parser.add_argument('--form', type=str, default='990', help='The IRS form type to process.')
     parser.add_argument('--recipient', action='store_true', default=False, help='Extract recipient organization data.')
     parser.add_argument('--schedule', type=str, default='', help='The schedule to extract, default is the index data.')
+    parser.add_argument('--products', type=lambda value: value.split(','), default=None, help=f'Comma-separated products to extract from a single parse of each filing: {", ".join(extraction_products)}.')
+    parser.add_argument('--streaming', action='store_true', default=False, help='Parse filings with iterparse so peak memory stays bounded on very large documents.')
+    parser.add_argument('--workers', type=int, default=1, help='Number of worker processes to spread filings across.')
+    parser.add_argument('--batch-size', type=int, default=64, help='Number of filings handed to a worker at a time.')
+    parser.add_argument('--download-workers', type=int, default=4, help='Number of ZIP batches to download at once.')
+    parser.add_argument('--cache', action='store_true', default=False, help='Reuse the variables extracted from each filing in earlier runs, and store the new ones.')
+    parser.add_argument('--cache-path', type=str, default=extraction_cache_path, help='SQLite file of the extraction cache.')
+    parser.add_argument('--cache-max-mb', type=int, default=extraction_cache_max_mb, help='Size limit of the extraction cache in MB; least recently used entries are evicted.')
+    parser.add_argument('--incremental', action='store_true', default=False, help='Re-download the index CSV and extract only filings not yet in the outputs, appending to them.')
+    parser.add_argument('--output-format', type=str, default='csv', choices=['csv', 'parquet'], help='Write CSV, or Parquet with typed columns flushed in row groups as batches complete.')
+    parser.add_argument('--row-group-size', type=int, default=10000, help='Rows per Parquet row group.')
+    parser.add_argument('--limit', type=int, default=None, help='Only extract the first N filings of the form type in the index.')
+    parser.add_argument('--sample', type=int, default=None, help='Only extract a random (repeatable) sample of N filings of the form type.')
+    parser.add_argument('--merge-aliases', action='store_true', default=False, help='Write the value of each pre-2013 element name into the column of its current name instead of a column of its own.')
+    parser.add_argument('--backend', type=str, default=default_xml_backend, choices=['lxml', 'etree'], help='XML parser: lxml (faster, used when installed) or the standard library ElementTree.')
+    parser.add_argument('--report', type=str, default=None, help='Path of the JSON run report; {year} is replaced by the year (default: result/{year}/run_report_{year}.json).')
+    parser.add_argument('--profile-every', type=int, default=None, help='Sample every Nth batch of filings with cProfile and save the combined profile to result/<year>/profile_<year>.prof.')
 
 
     args = parser.parse_args()
 
-    main(args.year, args.form, args.recipient, args.schedule)
+    if (args.tax_year or args.return_type) and not (args.ein or args.object_id):
+        parser.error("--tax-year and --return-type narrow a lookup; give --ein or --object-id as well.")
+
+    if args.build_store:
+        build_filing_store(args.years or [args.year], args.store)
+    elif args.ein or args.object_id:
+        lookup_df = lookup_filings(args.ein, args.tax_year, args.return_type, args.object_id, args.variables,
+                                   args.store, args.merge_aliases, args.backend, args.download_workers)
+        if args.output:
+            lookup_df.to_csv(args.output, index=False)
+            print(f"Saved {len(lookup_df)} filings to {args.output}.")
+        else:
+            print(lookup_df.to_csv(index=False), end='')
+    else:
+        main(args.years or [args.year], args.form, args.recipient, args.schedule, args.products, args.panel,
+             streaming=args.streaming, workers=args.workers, batch_size=args.batch_size,
+             download_workers=args.download_workers, cache_path=args.cache_path if args.cache else None,
+             cache_max_mb=args.cache_max_mb, incremental=args.incremental, output_format=args.output_format,
+             row_group_size=args.row_group_size, limit=args.limit, sample=args.sample,
+             merge_aliases=args.merge_aliases, backend=args.backend, report_path=args.report,
+             profile_every=args.profile_every)
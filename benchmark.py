@@ -0,0 +1,542 @@
+import xml.etree.ElementTree as ET
+import argparse
+import contextlib
+import importlib.util
+import json
+import multiprocessing
+import os
+import random
+import resource
+import shutil
+import sys
+import tempfile
+import time
+import zipfile
+
+# Run from the repository root so the generator script finds ./variables/
+repo_dir = os.path.dirname(os.path.abspath(__file__))
+os.chdir(repo_dir)
+
+# Load the generator script as a module (its file name is not importable directly)
+spec = importlib.util.spec_from_file_location('csv_generator', os.path.join(repo_dir, '990-csv-generator.py'))
+generator = importlib.util.module_from_spec(spec)
+# Registered so the worker pool can pickle the generator's functions by module name
+sys.modules['csv_generator'] = generator
+spec.loader.exec_module(generator)
+
+ns = generator.ns
+
+
+# The original per-variable root.find() extractor, kept here as the comparison baseline
+def legacy_extract_variables_and_attr_from_xml(xml_file, variables):
+    tree = ET.parse(xml_file)
+    root = tree.getroot()
+
+    extracted_data = {}
+    for var in variables:
+        xpath_expr = var.replace('/text()', '')
+        xpath_parts = xpath_expr.split('/')
+        xpath_expr = '/'.join('irs:' + part for part in xpath_parts if part)
+
+        element = root.find(xpath_expr, ns)
+        extracted_data[var] = element.text if element is not None else None
+        if element is not None:
+            for key, value in element.attrib.items():
+                extracted_data[f"{var}/{key}"] = value
+
+    return extracted_data
+
+
+# The original recipient extractor: every RecipientTable in the document, one findtext() per variable
+def legacy_extract_recipient_table(xml_file, object_id, recipient_variables):
+    root = ET.parse(xml_file).getroot()
+
+    recipient_data = []
+    for element in root.findall('.//irs:RecipientTable', ns):
+        recipient = {'OBJECT_ID': object_id}
+        for var in recipient_variables:
+            xpath_expr = '/'.join('irs:' + part for part in var.replace('/text()', '').split('/') if part)
+            recipient[var] = element.findtext(xpath_expr, default='', namespaces=ns)
+        recipient_data.append(recipient)
+
+    return recipient_data
+
+
+# Function to extract variables on lxml with one precompiled etree.XPath per variable, the
+# alternative to the path trie the lxml backend was measured against. Like extract_filing,
+# only the variables of the filings' schema era are looked up.
+def lxml_xpath_extractor(compiled_variables, era):
+    xpaths = {var: generator.lxml_etree.XPath(
+                  '(' + '/'.join('irs:' + part for part in var.replace('/text()', '').split('/') if part) + ')[1]',
+                  namespaces=ns)
+              for var in generator.era_variables(compiled_variables['variables'], era)}
+
+    def extract(xml_file):
+        root = generator.xml_backends['lxml']['parse'](xml_file).getroot()
+        matches = {}
+        for var, xpath in xpaths.items():
+            elements = xpath(root)
+            if elements:
+                matches[var] = elements[0]
+        return generator.build_extracted_data(compiled_variables, matches)
+
+    return extract
+
+
+# Function to build one synthetic 990 filing that populates a random subset of the variables
+def generate_synthetic_filing(variables, rng, fill_rate=0.6, noise_elements=200):
+    tag = lambda name: generator.ns_tag_prefix + name
+    root = ET.Element(tag('Return'), {'returnVersion': '2023v5.0'})
+
+    for var in variables:
+        if rng.random() > fill_rate:
+            continue
+        parts = [part for part in var.replace('/text()', '').split('/') if part]
+        parent = root
+        for part in parts[:-1]:
+            # Occasionally open a second sibling group so first-match ordering is exercised
+            existing = parent.find(tag(part))
+            if existing is None or rng.random() < 0.05:
+                existing = ET.SubElement(parent, tag(part))
+            parent = existing
+        leaf = ET.SubElement(parent, tag(parts[-1]))
+        leaf.text = str(rng.randint(0, 10_000_000))
+        if rng.random() < 0.1:
+            leaf.set('referenceDocumentId', f'RetDoc{rng.randint(1, 99)}')
+
+    # Elements no variable asks for, as found in the rest of a real return
+    return_data = root.find(tag('ReturnData'))
+    if return_data is None:
+        return_data = ET.SubElement(root, tag('ReturnData'))
+    filler = ET.SubElement(return_data, tag('IRS990ScheduleO'))
+    for i in range(noise_elements):
+        detail = ET.SubElement(filler, tag('SupplementalInformationDetail'))
+        ET.SubElement(detail, tag('FormAndLineReferenceDesc')).text = f'Part {i}'
+        ET.SubElement(detail, tag('ExplanationTxt')).text = 'Synthetic explanation text ' * 4
+
+    # A comment and a processing instruction among the sections and their children, as some
+    # filing software leaves them; lxml returns them as children whose tag is not a string
+    root.insert(0, ET.Comment(' generated '))
+    root[1].insert(0, ET.Comment(' generated '))
+    return_data.insert(0, ET.ProcessingInstruction('software', 'version="1.0"'))
+
+    return ET.ElementTree(root)
+
+
+# Function to write a corpus of synthetic filings and return their paths
+def generate_corpus(directory, variables, count, seed=0):
+    rng = random.Random(seed)
+    paths = []
+    for i in range(count):
+        path = os.path.join(directory, f'{202400000000000000 + i}_public.xml')
+        generate_synthetic_filing(variables, rng).write(path, xml_declaration=True, encoding='utf-8')
+        paths.append(path)
+    return paths
+
+
+def time_extractor(extract, xml_files, variables):
+    start = time.perf_counter()
+    results = [extract(xml_file, variables) for xml_file in xml_files]
+    return time.perf_counter() - start, results
+
+
+def bench_variable_extractors(filings):
+    variable_sets = {
+        'all_variables': (generator.all_variables, generator.all_variables_compiled),
+        'schedule_c_variables': (generator.schedule_c_variables, generator.schedule_c_variables_compiled),
+    }
+
+    with tempfile.TemporaryDirectory() as corpus_dir:
+        for name, (variables, compiled_variables) in variable_sets.items():
+            variable_set_dir = os.path.join(corpus_dir, name)
+            os.makedirs(variable_set_dir)
+            xml_files = generate_corpus(variable_set_dir, variables, filings)
+
+            legacy_seconds, legacy_results = time_extractor(legacy_extract_variables_and_attr_from_xml, xml_files, variables)
+            trie_seconds, trie_results = time_extractor(generator.extract_variables_and_attr_from_xml, xml_files, compiled_variables)
+            streaming_seconds, streaming_results = time_extractor(generator.stream_variables_and_attr_from_xml, xml_files, compiled_variables)
+
+            for label, results in (('Path-trie', trie_results), ('Streaming', streaming_results)):
+                if legacy_results != results:
+                    raise AssertionError(f"{label} extractor output differs from root.find() for {name}.")
+                if [list(r) for r in legacy_results] != [list(r) for r in results]:
+                    raise AssertionError(f"{label} extractor column order differs from root.find() for {name}.")
+
+            print(f"{name} ({len(variables)} variables, {filings} filings):")
+            print(f"  root.find() per variable: {legacy_seconds / filings * 1000:8.3f} ms/filing")
+            print(f"  compiled path trie:       {trie_seconds / filings * 1000:8.3f} ms/filing")
+            print(f"  streaming iterparse:      {streaming_seconds / filings * 1000:8.3f} ms/filing")
+            print(f"  speedup (compiled trie):  {legacy_seconds / trie_seconds:8.2f}x")
+
+
+def bench_backends(filings):
+    products = ['index', 'schedule_c', 'recipient']
+    compiled_variables = generator.compile_product_variables(products)
+
+    def extractor(backend, streaming):
+        def extract(xml_file):
+            schedules = set()
+            matches, table_rows = generator.extract_filing(xml_file, 0, products, streaming, backend=backend,
+                                                           schedules=schedules)
+            return generator.build_extracted_data(compiled_variables, matches), table_rows, schedules
+        return extract
+
+    with tempfile.TemporaryDirectory() as corpus_dir:
+        xml_files = generate_corpus(corpus_dir, compiled_variables['variables'], filings)
+
+        extractors = []
+        for backend in generator.xml_backends:
+            extractors.append((f'{backend}, path trie', extractor(backend, False)))
+            extractors.append((f'{backend}, --streaming', extractor(backend, True)))
+
+        print(f"XML backends ({len(compiled_variables['variables'])} variables, {filings} filings):")
+        results = {}
+        for label, extract in extractors:
+            start = time.perf_counter()
+            results[label] = [extract(xml_file) for xml_file in xml_files]
+            print(f"  {label:28s} {(time.perf_counter() - start) / filings * 1000:8.3f} ms/filing")
+
+        if 'lxml' in generator.xml_backends:
+            start = time.perf_counter()
+            # Synthetic filings carry a 2023 returnVersion
+            xpath_extract = lxml_xpath_extractor(compiled_variables, 'modern')
+            xpath_results = [xpath_extract(xml_file) for xml_file in xml_files]
+            print(f"  {'lxml, etree.XPath per var':28s} {(time.perf_counter() - start) / filings * 1000:8.3f} ms/filing")
+            if xpath_results != [extracted_data for extracted_data, _, _ in results[extractors[0][0]]]:
+                raise AssertionError("lxml XPath results differ from the path trie.")
+        else:
+            print("  lxml is not installed; only the ElementTree backend was measured.")
+
+        reference_label = extractors[0][0]
+        for label, _ in extractors[1:]:
+            if results[label] != results[reference_label]:
+                raise AssertionError(f"{label} results differ from {reference_label}.")
+
+
+# Function to write one very large filing with many Schedule I RecipientTable rows
+def generate_large_filing(path, recipient_rows, seed=0):
+    rng = random.Random(seed)
+    with open(path, 'w', encoding='utf-8') as file:
+        file.write(f'<?xml version="1.0" encoding="utf-8"?>\n<Return xmlns="{ns["irs"]}" returnVersion="2023v5.0">\n')
+        file.write('<ReturnHeader><Filer><EIN>123456789</EIN></Filer><TaxYr>2023</TaxYr></ReturnHeader>\n')
+        file.write('<ReturnData><IRS990><TotalContributionsAmt>1000000</TotalContributionsAmt></IRS990>\n<IRS990ScheduleI>\n')
+        for i in range(recipient_rows):
+            file.write('<RecipientTable>'
+                       f'<RecipientBusinessName><BusinessNameLine1Txt>Recipient {i}</BusinessNameLine1Txt></RecipientBusinessName>'
+                       f'<USAddress><AddressLine1Txt>{i} Main St</AddressLine1Txt><CityNm>Springfield</CityNm>'
+                       '<StateAbbreviationCd>IL</StateAbbreviationCd><ZIPCd>62701</ZIPCd></USAddress>'
+                       f'<RecipientEIN>{rng.randint(10**8, 10**9 - 1)}</RecipientEIN><IRCSectionDesc>501(c)(3)</IRCSectionDesc>'
+                       f'<CashGrantAmt>{rng.randint(1000, 10**6)}</CashGrantAmt><PurposeOfGrantTxt>General support</PurposeOfGrantTxt>'
+                       '</RecipientTable>\n')
+        file.write('</IRS990ScheduleI></ReturnData>\n</Return>\n')
+
+
+# Function run in a fresh process: extract one filing and report the process's RSS
+# before the extraction and at its peak
+def measure_peak_rss(extractor, xml_file, queue):
+    baseline = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if extractor in ('extract_variables_and_attr_from_xml', 'stream_variables_and_attr_from_xml'):
+        getattr(generator, extractor)(xml_file, generator.all_variables_compiled)
+    else:
+        getattr(generator, extractor)(xml_file, 0, generator.recipient_table)
+    queue.put((baseline, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss))
+
+
+def bench_peak_rss(recipient_rows):
+    context = multiprocessing.get_context('spawn')
+    # ru_maxrss is reported in kilobytes on Linux and in bytes on macOS
+    rss_unit = 2**20 if os.uname().sysname == 'Darwin' else 2**10
+
+    with tempfile.TemporaryDirectory() as corpus_dir:
+        xml_file = os.path.join(corpus_dir, 'large_public.xml')
+        generate_large_filing(xml_file, recipient_rows)
+        size_mb = os.path.getsize(xml_file) / 2**20
+
+        print(f"Peak RSS on one {size_mb:.1f} MB filing with {recipient_rows} RecipientTable rows:")
+        extractors = (
+            ('variables, ET.parse (before)', 'extract_variables_and_attr_from_xml'),
+            ('variables, --streaming (after)', 'stream_variables_and_attr_from_xml'),
+            ('recipients, ET.parse (before)', 'extract_table'),
+            ('recipients, --streaming (after)', 'stream_table'),
+        )
+        for label, extractor in extractors:
+            queue = context.Queue()
+            process = context.Process(target=measure_peak_rss, args=(extractor, xml_file, queue))
+            process.start()
+            baseline, peak = queue.get()
+            process.join()
+            print(f"  {label:32s} {peak / rss_unit:8.1f} MB peak RSS "
+                  f"(+{(peak - baseline) / rss_unit:.1f} MB over {baseline / rss_unit:.1f} MB at start)")
+
+        # Checked after measuring, since child processes inherit this process's RSS high-water mark
+        dom_rows = generator.extract_table(xml_file, 0, generator.recipient_table)
+        if generator.stream_table(xml_file, 0, generator.recipient_table) != dom_rows:
+            raise AssertionError("Streaming recipient rows differ from the ElementTree extractor.")
+
+
+def bench_table_extractors(recipient_rows):
+    recipient_variables = [var for _, var in generator.recipient_table_variables]
+
+    with tempfile.TemporaryDirectory() as corpus_dir:
+        xml_file = os.path.join(corpus_dir, 'large_public.xml')
+        generate_large_filing(xml_file, recipient_rows)
+
+        timings = {}
+        results = {}
+        extractors = (
+            ('findtext() per variable', lambda: legacy_extract_recipient_table(xml_file, 0, recipient_variables)),
+            ('prefix-scoped row walk', lambda: generator.extract_table(xml_file, 0, generator.recipient_table)),
+            ('streaming row walk', lambda: generator.stream_table(xml_file, 0, generator.recipient_table)),
+        )
+        for label, extract in extractors:
+            start = time.perf_counter()
+            results[label] = extract()
+            timings[label] = time.perf_counter() - start
+
+        legacy_label = extractors[0][0]
+        for label, _ in extractors[1:]:
+            if results[label] != results[legacy_label]:
+                raise AssertionError(f"{label} recipient rows differ from {legacy_label}.")
+
+        print(f"Recipient table ({recipient_rows} rows, {len(recipient_variables)} variables):")
+        for label, seconds in timings.items():
+            print(f"  {label:24s} {seconds / recipient_rows * 1e6:8.2f} us/row "
+                  f"({timings[legacy_label] / seconds:.2f}x)")
+
+
+# Share of filings attaching each schedule in the end-to-end corpus. Schedule O is part of
+# every synthetic filing (it carries the filler elements).
+default_schedule_mix = {'A': 0.9, 'B': 0.6, 'C': 0.1, 'D': 0.4, 'I': 0.15, 'R': 0.2}
+
+
+# Function to tell which schedule a variable belongs to ('C' for ReturnData/IRS990ScheduleC/...), if any
+def variable_schedule(var):
+    parts = var.split('/')
+    if len(parts) > 1 and parts[1].startswith('IRS990Schedule'):
+        return parts[1][len('IRS990Schedule'):]
+    return None
+
+
+# Function to build one end-to-end corpus filing with the given schedules. Only current (2013+)
+# element names are used, as in a filing of the returnVersion the generator writes.
+def generate_corpus_filing(rng, schedules, recipient_rows, noise_elements):
+    variables = [var for var in generator.era_variables(generator.all_variables, 'modern')
+                 if variable_schedule(var) in (None, *schedules)]
+    if 'C' in schedules:
+        variables += generator.era_variables(generator.schedule_c_variables, 'modern')
+    tree = generate_synthetic_filing(variables, rng, noise_elements=noise_elements)
+
+    tag = lambda name: generator.ns_tag_prefix + name
+    return_data = tree.getroot().find(tag('ReturnData'))
+    for schedule in schedules:
+        schedule_element = return_data.find(tag('IRS990Schedule' + schedule))
+        if schedule_element is None:
+            schedule_element = ET.SubElement(return_data, tag('IRS990Schedule' + schedule))
+            ET.SubElement(schedule_element, tag('SupplementalInformationDetail'))
+
+    if 'I' in schedules:
+        schedule_i = return_data.find(tag('IRS990ScheduleI'))
+        for i in range(recipient_rows):
+            recipient = ET.SubElement(schedule_i, tag('RecipientTable'))
+            name = ET.SubElement(recipient, tag('RecipientBusinessName'))
+            ET.SubElement(name, tag('BusinessNameLine1Txt')).text = f'Recipient {i}'
+            address = ET.SubElement(recipient, tag('USAddress'))
+            ET.SubElement(address, tag('AddressLine1Txt')).text = f'{i} Main St'
+            ET.SubElement(address, tag('CityNm')).text = 'Springfield'
+            ET.SubElement(address, tag('StateAbbreviationCd')).text = 'IL'
+            ET.SubElement(address, tag('ZIPCd')).text = '62701'
+            ET.SubElement(recipient, tag('RecipientEIN')).text = str(rng.randint(10**8, 10**9 - 1))
+            ET.SubElement(recipient, tag('CashGrantAmt')).text = str(rng.randint(1000, 10**6))
+            ET.SubElement(recipient, tag('PurposeOfGrantTxt')).text = 'General support'
+
+    return tree
+
+
+# Function to write an offline workspace the generator script can run in: the year's
+# index_<year>.csv and ZIP batches of synthetic filings, laid out as the IRS publishes them.
+# A quarter of the index rows are other return types, which the extraction filters out.
+# Returns the number of 990 filings and their total uncompressed size in bytes.
+def generate_workspace(workspace, year, filings, schedule_mix, recipient_rows, noise_elements,
+                       batch_size=500, seed=0):
+    rng = random.Random(seed)
+    index_dir = os.path.join(workspace, 'data', 'index_file')
+    xml_dir = os.path.join(workspace, 'data', 'xml_files', str(year))
+    os.makedirs(index_dir)
+    os.makedirs(xml_dir)
+
+    index_rows = []
+    xml_bytes = 0
+    archive = None
+    for i in range(filings):
+        if i % batch_size == 0:
+            if archive is not None:
+                archive.close()
+            xml_batch_id = f'{year}_TEOS_XML_{i // batch_size + 1:02d}A'
+            archive = zipfile.ZipFile(os.path.join(xml_dir, f'{xml_batch_id}.zip'), 'w', zipfile.ZIP_DEFLATED)
+
+        object_id = f'{year}0{i:013d}'
+        schedules = [schedule for schedule, share in sorted(schedule_mix.items()) if rng.random() < share]
+        tree = generate_corpus_filing(rng, schedules, max(1, int(rng.expovariate(1 / recipient_rows))),
+                                      noise_elements)
+        xml_data = ET.tostring(tree.getroot(), xml_declaration=True, encoding='utf-8')
+        archive.writestr(f'{xml_batch_id}/{object_id}_public.xml', xml_data)
+        xml_bytes += len(xml_data)
+        index_rows.append(f'{i},EFILE,{rng.randint(10**8, 10**9 - 1)},{year - 1}12,{year}-05-15,'
+                          f'ORGANIZATION {i},990,{93493000000000 + i},{object_id},{xml_batch_id}')
+        if i % 3 == 0:
+            # Other return types share the index but have no filings in this corpus
+            index_rows.append(f'{i},EFILE,{rng.randint(10**8, 10**9 - 1)},{year - 1}12,{year}-05-15,'
+                              f'FOUNDATION {i},990PF,{93491000000000 + i},{year}9{i:013d},{xml_batch_id}')
+    if archive is not None:
+        archive.close()
+
+    with open(os.path.join(index_dir, f'index_{year}.csv'), 'w') as file:
+        file.write(','.join(generator.index_columns) + '\n' + '\n'.join(index_rows) + '\n')
+
+    return filings, xml_bytes
+
+
+# Function to read this process's peak RSS in MB. On Linux VmHWM is used, which unlike
+# ru_maxrss does not carry over the high-water mark of the process that spawned this one.
+def peak_rss_mb():
+    try:
+        with open('/proc/self/status') as status:
+            for line in status:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    # ru_maxrss is reported in kilobytes on Linux and in bytes on macOS
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / (2**20 if sys.platform == 'darwin' else 2**10)
+
+
+# Extraction paths timed end to end, by name
+end_to_end_paths = {
+    'index': lambda year, options: generator.extract_index_data(year, '990', **options),
+    'schedule_c': lambda year, options: generator.extract_schedule_c_data(year, **options),
+    'recipient': lambda year, options: generator.extract_recipient_data(year, **options),
+}
+
+
+# Function run in a fresh process: run one extraction path in the workspace from a clean
+# state (no outputs, manifests or schedule index) and report its wall time and peak RSS
+def run_end_to_end(workspace, path, year, options, queue):
+    os.chdir(workspace)
+    for directory in ('result', 'data/manifest', 'data/schedule_index'):
+        shutil.rmtree(directory, ignore_errors=True)
+
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        start = time.perf_counter()
+        end_to_end_paths[path](year, options)
+        seconds = time.perf_counter() - start
+    # With --workers the largest worker process may exceed the main one
+    workers_peak_mb = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / (2**20 if sys.platform == 'darwin' else 2**10)
+    queue.put((seconds, max(peak_rss_mb(), workers_peak_mb)))
+
+
+# Function to generate the corpus, time each extraction path on it and save or check the
+# JSON baseline. Returns False if the results regressed against the baseline.
+def bench_end_to_end(args):
+    context = multiprocessing.get_context('spawn')
+    schedule_mix = dict(default_schedule_mix)
+    for item in args.schedule_mix.split(',') if args.schedule_mix else []:
+        schedule, share = item.split('=')
+        schedule_mix[schedule.strip().upper()] = float(share)
+    options = {'workers': args.workers, 'streaming': args.streaming, 'cache_path': None, 'download_workers': 1}
+    if args.backend:
+        options['backend'] = args.backend
+
+    config = {
+        'filings': args.corpus_filings,
+        'schedule_mix': schedule_mix,
+        'recipient_rows': args.schedule_i_rows,
+        'noise_elements': args.noise_elements,
+        'options': options,
+    }
+
+    with tempfile.TemporaryDirectory() as workspace:
+        start = time.perf_counter()
+        filings, xml_bytes = generate_workspace(workspace, args.year, args.corpus_filings, schedule_mix,
+                                                args.schedule_i_rows, args.noise_elements)
+        print(f"Generated {filings} filings ({xml_bytes / 2**20:.1f} MB of XML) in "
+              f"{time.perf_counter() - start:.1f} s.")
+
+        results = {}
+        print(f"End-to-end extraction ({', '.join(f'{key}={value}' for key, value in options.items())}):")
+        for path in end_to_end_paths:
+            queue = context.Queue()
+            process = context.Process(target=run_end_to_end, args=(workspace, path, args.year, options, queue))
+            process.start()
+            process.join()
+            if process.exitcode != 0:
+                raise RuntimeError(f"The {path} extraction failed (exit code {process.exitcode}).")
+            seconds, peak_mb = queue.get()
+            results[path] = {
+                'seconds': seconds,
+                'filings_per_sec': filings / seconds,
+                'mb_per_sec': xml_bytes / 2**20 / seconds,
+                'peak_rss_mb': peak_mb,
+            }
+            print(f"  {path:12s} {seconds:8.2f} s {filings / seconds:9.1f} filings/s "
+                  f"{xml_bytes / 2**20 / seconds:8.2f} MB/s {peak_mb:8.1f} MB peak RSS")
+
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as file:
+            json.dump({'config': config, 'results': results}, file, indent=2)
+        print(f"Saved baseline to {args.save_baseline}.")
+
+    if args.baseline:
+        return compare_to_baseline(args.baseline, config, results, args.tolerance)
+    return True
+
+
+# Function to compare results with a saved baseline: a path regresses when its throughput drops,
+# or its peak memory grows, by more than the tolerance. Returns False if any path regressed.
+def compare_to_baseline(baseline_path, config, results, tolerance):
+    with open(baseline_path) as file:
+        baseline = json.load(file)
+    if baseline['config'] != config:
+        print(f"Warning: the baseline in {baseline_path} was measured with a different configuration.")
+
+    passed = True
+    for path, result in results.items():
+        if path not in baseline['results']:
+            continue
+        expected = baseline['results'][path]
+        throughput_change = result['filings_per_sec'] / expected['filings_per_sec'] - 1
+        memory_change = result['peak_rss_mb'] / expected['peak_rss_mb'] - 1
+        regressed = throughput_change < -tolerance or memory_change > tolerance
+        passed = passed and not regressed
+        print(f"  {path:12s} throughput {throughput_change:+7.1%}, peak RSS {memory_change:+7.1%} vs baseline"
+              f"{'  REGRESSION' if regressed else ''}")
+
+    return passed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the XML variable extractors on synthetic 990 filings.")
+    parser.add_argument('--filings', type=int, default=200, help='Number of synthetic filings per variable set.')
+    parser.add_argument('--recipient-rows', type=int, default=50000, help='RecipientTable rows in the large filing used for the peak RSS comparison.')
+    parser.add_argument('--end-to-end', action='store_true', default=False, help='Time the extract_index_data, extract_schedule_c_data and extract_recipient_data paths on a generated offline corpus instead.')
+    parser.add_argument('--year', type=int, default=2024, help='Year of the generated index and ZIP batches.')
+    parser.add_argument('--corpus-filings', type=int, default=1000, help='Number of 990 filings in the end-to-end corpus.')
+    parser.add_argument('--schedule-mix', type=str, default='', help='Share of filings attaching each schedule, e.g. C=0.1,I=0.3 (overrides the defaults per schedule).')
+    parser.add_argument('--schedule-i-rows', type=int, default=20, help='Average RecipientTable rows per filing with Schedule I.')
+    parser.add_argument('--noise-elements', type=int, default=200, help='Schedule O filler elements per filing, which sets the filing size.')
+    parser.add_argument('--workers', type=int, default=1, help='Worker processes for the end-to-end runs.')
+    parser.add_argument('--streaming', action='store_true', default=False, help='Run the end-to-end extraction in streaming mode.')
+    parser.add_argument('--backend', type=str, default=None, help='XML backend for the end-to-end runs (default: the script default).')
+    parser.add_argument('--save-baseline', type=str, default=None, help='Write the end-to-end results to this JSON file.')
+    parser.add_argument('--baseline', type=str, default=None, help='Compare the end-to-end results with this JSON baseline and exit non-zero on a regression.')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='Allowed relative drop in throughput or growth in peak RSS before a regression is reported.')
+
+    args = parser.parse_args()
+
+    if args.end_to_end:
+        sys.exit(0 if bench_end_to_end(args) else 1)
+
+    # Peak RSS first: spawned processes inherit this process's RSS high-water mark
+    bench_peak_rss(args.recipient_rows)
+    bench_variable_extractors(args.filings)
+    bench_backends(args.filings)
+    bench_table_extractors(args.recipient_rows)